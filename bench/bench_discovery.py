@@ -0,0 +1,58 @@
+"""Discovery against emulated devices on loopback addresses (127.0.0.x):
+probes run one after the other vs in parallel, and /discover_devices
+answered from the cache.
+
+Usage: python bench/bench_discovery.py [--devices 8] [--timeout 1]
+"""
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from devices import DeviceRegistry
+from discovery import DiscoveryService
+from emulator import EmulatedDevice
+from web import web
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=1)
+    args = parser.parse_args()
+
+    # One emulated device per address, all on the same port
+    first = EmulatedDevice('127.0.0.2', 0, mac='0000000000ff').start()
+    port = first.address[1]
+    emulators = [first] + [EmulatedDevice(f'127.0.0.{i + 2}', port, mac=f'0000000000{i:02x}').start()
+                           for i in range(1, args.devices)]
+    targets = [('127.0.0.1', emulator.address[0]) for emulator in emulators]
+    try:
+        start = time.perf_counter()
+        found = 0
+        for target in targets:
+            found += len(DiscoveryService([target], port, args.timeout, interval=0).refresh())
+        sequential = time.perf_counter() - start
+
+        service = DiscoveryService(targets, port, args.timeout, interval=0)
+        start = time.perf_counter()
+        devices = service.refresh()
+        parallel = time.perf_counter() - start
+        print(f"{args.devices} interfaces, {args.timeout}s probes")
+        print(f"sequential probes {sequential:6.2f} s, {found} devices")
+        print(f"parallel probes   {parallel:6.2f} s, {len(devices)} devices")
+
+        server = web(None, None, DeviceRegistry(), None, None, None, service)
+        client = server.app.test_client()
+        count = 200
+        start = time.perf_counter()
+        for _ in range(count):
+            result = client.post('/discover_devices').json
+        elapsed = time.perf_counter() - start
+        print(f"/discover_devices from the cache: {elapsed / count * 1000:.2f} ms, "
+              f"{len(result['devices'])} devices")
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
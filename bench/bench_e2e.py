@@ -0,0 +1,189 @@
+"""End-to-end benchmark: the real Scheduler and web server against emulated
+devices (bench/emulator.py) with a synthetic jobs.json and data.json.
+
+Reports the load time and memory, the fire-time jitter (arrival of the
+first code of each job at the emulator vs its scheduled time), the web
+latency while jobs fire, the reload latency of hand edits of jobs.json
+and the send throughput.
+
+Usage: python bench/bench_e2e.py [--jobs 300] [--commands 3000] [--devices 2] [--spread 20]
+"""
+import argparse, datetime, json, logging, os, resource, shutil, socket, sys, tempfile, threading, time
+import urllib.error, urllib.parse, urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from emulator import EmulatedDevice
+from scheduler import Scheduler
+from jobs import JobRepository
+from storage import JsonStore, data_key
+from web import web
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "no samples"
+    pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    return (f"p50 {pick(0.5) * 1000:7.1f} ms  p95 {pick(0.95) * 1000:7.1f} ms  "
+            f"p99 {pick(0.99) * 1000:7.1f} ms  max {values[-1] * 1000:7.1f} ms")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_files(directory, emulators, commands, jobs, start, spread):
+    data = [{'type': 'location', 'settings': {'timezone': 'Europe/Paris', 'lat': 43.3, 'long': 5.36}}]
+    for i, emulator in enumerate(emulators):
+        data.append({'type': 'device', 'name': f'dev{i}', 'settings': {
+            'devtype': '0x5213', 'host': emulator.address[0], 'port': emulator.address[1],
+            'mac': emulator.mac.hex(), 'frequency': 433.92}})
+    payloads = {}
+    for i in range(commands):
+        body = os.urandom(200 + (i * 37) % 1000)
+        payload = bytes([0xb2, 0]) + len(body).to_bytes(2, 'little') + body
+        payloads[payload] = f'cmd{i}'
+        data.append({'name': f'cmd{i}', 'type': 'command', 'data': payload.hex(),
+                     'device': f'dev{i % len(emulators)}'})
+
+    # The first code of each job is unique, its arrival gives the fire time
+    expected = {}
+    job_list = []
+    for j in range(jobs):
+        due = start + datetime.timedelta(seconds=int(j * spread / jobs))
+        first, second = f'cmd{(2 * j) % commands}', f'cmd{(2 * j + 1) % commands}'
+        expected[first] = due.timestamp()
+        job_list.append({'name': f'job{j}', 'time': due.strftime('%H:%M:%S'), 'enabled': True,
+                         'parameters': {'action1': [first], 'delay': 1, 'action2': [second],
+                                        'weekday': True, 'weekend': True}})
+    job_list.append({'name': 'toggled', 'time': '03:00', 'enabled': True,
+                     'parameters': {'action1': ['cmd0'], 'delay': 0, 'action2': [],
+                                    'weekday': True, 'weekend': True}})
+
+    for name, content in (('data.json', data), ('jobs.json', job_list)):
+        with open(os.path.join(directory, name), 'w') as f:
+            json.dump(content, f, indent=4)
+    return payloads, expected
+
+
+def request(url, form=None):
+    data = urllib.parse.urlencode(form).encode() if form is not None else None
+    start = time.perf_counter()
+    try:
+        urllib.request.urlopen(urllib.request.Request(url, data), timeout=10).read()
+    except urllib.error.HTTPError:
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=300)
+    parser.add_argument("--commands", type=int, default=3000)
+    parser.add_argument("--devices", type=int, default=2)
+    parser.add_argument("--spread", type=int, default=20, help="jobs fire over this many seconds")
+    parser.add_argument("--sends", type=int, default=1000, help="sends of the throughput test")
+    args = parser.parse_args()
+
+    # Only warnings and errors, not every request and send
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    directory = tempfile.mkdtemp()
+    emulators = [EmulatedDevice(mac=f'00000000{i:04x}').start() for i in range(args.devices)]
+    start = datetime.datetime.now().replace(microsecond=0) + datetime.timedelta(seconds=8)
+    payloads, expected = make_files(directory, emulators, args.commands, args.jobs, start, args.spread)
+    data_file, jobs_file = os.path.join(directory, 'data.json'), os.path.join(directory, 'jobs.json')
+
+    rss = rss_kb()
+    load_start = time.perf_counter()
+    data = JsonStore(data_file, data_key)
+    jobs = JobRepository(jobs_file)
+    scheduler = Scheduler(data, jobs)
+    scheduler.discovery.interval = 0
+    load = time.perf_counter() - load_start
+    print(f"{args.jobs} jobs, {args.commands} commands, {args.devices} emulated devices")
+    print(f"load          {load * 1000:8.1f} ms, RSS +{(rss_kb() - rss) / 1024:.1f} MB")
+
+    server = web(data, jobs, scheduler.devices, scheduler.commands,
+                 scheduler.update_jobs, scheduler.update_data, scheduler.discovery)
+    port = free_port()
+    server.start('pool', 8, host='127.0.0.1', port=port)
+    base = f'http://127.0.0.1:{port}'
+    threading.Thread(target=scheduler.run, daemon=True).start()
+
+    try:
+        # Web latency while the jobs fire
+        while datetime.datetime.now() < start:
+            time.sleep(0.05)
+        latencies = []
+        deadline = time.time() + args.spread + 10
+        while time.time() < deadline:
+            latencies.append(request(base + '/'))
+            latencies.append(request(base + '/toggle_job', {'name': 'toggled'}))
+            received = sum(len(emulator.received) for emulator in emulators)
+            if received >= 2 * args.jobs:
+                break
+            time.sleep(0.05)
+
+        jitter = []
+        for emulator in emulators:
+            for arrival, payload in emulator.received:
+                name = payloads.get(payload)
+                if name in expected:
+                    jitter.append(arrival - expected.pop(name))
+        print(f"fire jitter   {percentiles(jitter)}  ({len(expected)} jobs not fired)")
+        print(f"web latency   {percentiles(latencies)}  ({len(latencies)} requests)")
+
+        # Hand edits of jobs.json, until the timer has the new job
+        reloads = []
+        for i in range(10):
+            with open(jobs_file, 'r') as f:
+                content = json.load(f)
+            content.append({'name': f'edit{i}', 'time': '04:00', 'enabled': True,
+                            'parameters': {'action1': ['cmd0'], 'delay': 0, 'action2': [],
+                                           'weekday': True, 'weekend': True}})
+            edit_start = time.perf_counter()
+            with open(jobs_file + '.edit', 'w') as f:
+                json.dump(content, f, indent=4)
+            os.replace(jobs_file + '.edit', jobs_file)
+            while (job := jobs.find(f'edit{i}')) is None or ('job', job['id']) not in scheduler.timer.keys():
+                if time.perf_counter() - edit_start > 10:
+                    break
+                time.sleep(0.001)
+            reloads.append(time.perf_counter() - edit_start)
+        print(f"reload        {percentiles(reloads)}")
+
+        # Throughput: everything due now on the first device
+        emulator = emulators[0]
+        before = len(emulator.received)
+        signal = scheduler.commands.get('cmd0')
+        send_start = time.perf_counter()
+        for _ in range(args.sends):
+            scheduler.devices.send('dev0', 'cmd0', signal, time.time())
+        while len(emulator.received) - before < args.sends and time.perf_counter() - send_start < 60:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - send_start
+        print(f"throughput    {(len(emulator.received) - before) / elapsed:8.0f} sends/s on one device")
+        print(f"memory        RSS {rss_kb() / 1024:.1f} MB, peak {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+    finally:
+        scheduler.stop()
+        server.stop()
+        scheduler.close()
+        for emulator in emulators:
+            emulator.stop()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Load time and memory of the command library: data.json (hex, fully
+decoded at load) vs the binary library (index only, payloads memory-mapped
+on first send).
+
+Usage: python bench/bench_library.py [--commands 1000]
+"""
+import argparse, json, os, resource, shutil, subprocess, sys, tempfile, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(mode, directory):
+    # Measured in a fresh process so the RSS of each mode is not mixed
+    from commands import CommandStore
+    from library import CommandLibrary
+
+    before = rss_kb()
+    start = time.perf_counter()
+    if mode == 'json':
+        with open(os.path.join(directory, 'data.json'), 'r') as f:
+            data = json.load(f)
+        commands = CommandStore()
+        commands.load(data)
+    else:
+        commands = CommandStore(CommandLibrary(os.path.join(directory, 'commands')))
+    names = commands.names()
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    commands.get(names[0])
+    first_send = time.perf_counter() - start
+    print(json.dumps({'load': load, 'first_send': first_send, 'rss': rss_kb() - before}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=1000)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    from library import import_json
+    directory = tempfile.mkdtemp()
+    try:
+        data = [{'name': f'cmd{i}', 'type': 'command', 'data': os.urandom(1200).hex()}
+                for i in range(args.commands)]
+        with open(os.path.join(directory, 'data.json'), 'w') as f:
+            json.dump(data, f, indent=4)
+        import_json(os.path.join(directory, 'data.json'), os.path.join(directory, 'commands'))
+
+        for name in ('data.json', 'commands.idx', 'commands.bin'):
+            print(f"{name:13} {os.path.getsize(os.path.join(directory, name)) / 1024:8.1f} KB")
+        for mode in ('json', 'library'):
+            output = subprocess.check_output([sys.executable, __file__, '--child', mode, directory])
+            result = json.loads(output)
+            print(f"{mode:8} load={result['load'] * 1000:8.2f} ms  first send={result['first_send'] * 1000:6.3f} ms"
+                  f"  RSS +{result['rss'] / 1024:6.1f} MB")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
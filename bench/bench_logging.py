@@ -0,0 +1,95 @@
+"""Per-send logging overhead on the calling thread: the former flushed
+print, logging written by the caller, and the queue-backed logging of
+logs.py (text and JSON). Output goes to a file, then to a sink whose
+flush takes --latency us (a busy journald pipe or a slow SD card).
+
+Usage: python bench/bench_logging.py [--sends 20000] [--latency 200]
+"""
+import argparse, logging, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import logs
+
+
+class SlowFile:
+    """File whose flush blocks for a while, like a full pipe"""
+
+    def __init__(self, path, latency):
+        self.file = open(path, 'w')
+        self.latency = latency
+
+    def write(self, text):
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+        time.sleep(self.latency)
+
+    def close(self):
+        self.file.close()
+
+
+def send_print(i):
+    late = 0.0012
+    print(f"Send cmd{i % 10} on 'device' ({late * 1000:.0f} ms late)", flush=True)
+
+
+def send_log(i, log=logging.getLogger('devices')):
+    late = 0.0012
+    log.info("Send %s on '%s' (%.0f ms late)", f"cmd{i % 10}", 'device', late * 1000,
+             extra={'event': 'command_sent', 'device': 'device', 'command': f"cmd{i % 10}", 'late': late})
+
+
+def measure(mode, sends, path, latency):
+    # Returns the time per call on the sending thread and until everything is written
+    stdout = sys.stdout
+    sys.stdout = SlowFile(path, latency) if latency else open(path, 'w')
+    listener = None
+    root = logging.getLogger()
+    try:
+        if mode == 'direct':
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+            root.handlers[:] = [handler]
+            root.setLevel(logging.INFO)
+        elif mode != 'print':
+            listener = logs.setup('INFO', fmt=mode.split('-')[1])
+        send = send_print if mode == 'print' else send_log
+
+        start = time.perf_counter()
+        for i in range(sends):
+            send(i)
+        caller = time.perf_counter() - start
+        if listener is not None:
+            listener.stop()
+        total = time.perf_counter() - start
+    finally:
+        root.handlers[:] = []
+        sys.stdout.close()
+        sys.stdout = stdout
+    return caller / sends, total / sends
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sends", type=int, default=20000)
+    parser.add_argument("--latency", type=int, default=200, help="flush time of the slow sink (us)")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'out.log')
+    try:
+        for latency in (0, args.latency / 1e6):
+            # Fewer sends with the slow sink, the flushed print takes the full latency
+            sends = args.sends if not latency else min(args.sends, 2000)
+            print(f"sink flush latency {latency * 1e6:.0f} us, {sends} sends")
+            for mode in ('print', 'direct', 'queue-text', 'queue-json'):
+                caller, total = measure(mode, sends, path, latency)
+                print(f"  {mode:10} {caller * 1e6:8.2f} us/send on the sending thread,"
+                      f" {total * 1e6:8.2f} us/send until written")
+    finally:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+
+if __name__ == "__main__":
+    main()
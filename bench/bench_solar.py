@@ -0,0 +1,55 @@
+"""Startup and per-day cost of the sun times: one astral call per lookup
+(former get_sun) vs SolarTable (one pass per year, disk cache, O(1) lookup).
+
+Usage: python bench/bench_solar.py [--days 365]
+"""
+import argparse, datetime, os, shutil, sys, tempfile, time
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from astral import LocationInfo
+from astral.sun import sun
+from solar import SolarTable
+
+LAT, LONG, TIMEZONE = 43.3, 5.36, 'Europe/Paris'
+
+
+def astral_call(date):
+    # Same computation as the former Scheduler.get_sun
+    city = LocationInfo(name="", region="", timezone=TIMEZONE, latitude=LAT, longitude=LONG)
+    return sun(city.observer, date=date, tzinfo=pytz.timezone(TIMEZONE))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=365)
+    args = parser.parse_args()
+    dates = [datetime.date(2026, 1, 1) + datetime.timedelta(days=i) for i in range(args.days)]
+
+    start = time.perf_counter()
+    astral_call(dates[0])
+    print(f"astral  startup: {(time.perf_counter() - start) * 1000:8.3f} ms")
+    start = time.perf_counter()
+    for date in dates:
+        astral_call(date)['dusk']
+    print(f"astral  per day: {(time.perf_counter() - start) * 1000 / len(dates):8.3f} ms")
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.perf_counter()
+        SolarTable(LAT, LONG, TIMEZONE, cache_dir).get(dates[0], 'dusk')
+        print(f"table   startup (cold cache): {(time.perf_counter() - start) * 1000:8.3f} ms")
+        start = time.perf_counter()
+        table = SolarTable(LAT, LONG, TIMEZONE, cache_dir)
+        table.get(dates[0], 'dusk')
+        print(f"table   startup (warm cache): {(time.perf_counter() - start) * 1000:8.3f} ms")
+        start = time.perf_counter()
+        for date in dates:
+            table.get(date, 'dusk')
+        print(f"table   per day: {(time.perf_counter() - start) * 1000 / len(dates):8.3f} ms")
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
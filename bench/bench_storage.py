@@ -0,0 +1,95 @@
+"""Toggle/add latency against the command library size: former full JSON
+rewrites vs JsonStore (write-ahead log + periodic compaction).
+
+Usage: python bench/bench_storage.py [--sizes 10 100 1000] [--ops 50]
+"""
+import argparse, json, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from storage import JsonStore, data_key, job_key
+
+
+def make_files(directory, size):
+    data = [{'name': f'cmd{i}', 'type': 'command',
+             'data': os.urandom(1200).hex()} for i in range(size)]
+    jobs = [{'name': f'job{i}', 'time': '08:00', 'enabled': True,
+             'parameters': {'action1': ['cmd0'], 'delay': 0, 'action2': [],
+                            'weekday': True, 'weekend': True}} for i in range(20)]
+    data_file = os.path.join(directory, 'data.json')
+    jobs_file = os.path.join(directory, 'jobs.json')
+    with open(data_file, 'w') as f:
+        json.dump(data, f, indent=4)
+    with open(jobs_file, 'w') as f:
+        json.dump(jobs, f, indent=4)
+    return data_file, jobs_file
+
+
+def legacy(data_file, jobs_file, ops):
+    # Same file accesses as the former web handlers
+    with open(jobs_file, 'r') as f:
+        jobs_data = json.load(f)
+
+    start = time.perf_counter()
+    for i in range(ops):
+        job = jobs_data[i % len(jobs_data)]
+        job['enabled'] = not job['enabled']
+        with open(jobs_file, 'w') as f:
+            json.dump(jobs_data, f, indent=4)
+    toggle = (time.perf_counter() - start) / ops
+
+    start = time.perf_counter()
+    for i in range(ops):
+        with open(data_file, 'r') as f:
+            data = json.load(f)
+        data.append({'type': 'command', 'name': f'new{i}', 'data': os.urandom(1200).hex()})
+        with open(data_file, 'w') as f:
+            json.dump(data, f, indent=4)
+    add = (time.perf_counter() - start) / ops
+    return toggle, add
+
+
+def store(data_file, jobs_file, ops):
+    data = JsonStore(data_file, data_key)
+    jobs = JsonStore(jobs_file, job_key)
+
+    start = time.perf_counter()
+    for i in range(ops):
+        name = f'job{i % 20}'
+
+        def toggle(jobs_data):
+            for i, job in enumerate(jobs_data):
+                if job['name'] == name:
+                    jobs_data[i] = dict(job, enabled=not job['enabled'])
+        jobs.modify(toggle)
+    toggle = (time.perf_counter() - start) / ops
+
+    start = time.perf_counter()
+    for i in range(ops):
+        entry = {'type': 'command', 'name': f'new{i}', 'data': os.urandom(1200).hex()}
+        data.modify(lambda data_list: data_list.append(entry))
+    add = (time.perf_counter() - start) / ops
+    return toggle, add
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument("--ops", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'commands':>8} {'legacy toggle':>14} {'store toggle':>13} {'legacy add':>11} {'store add':>10}  (ms)")
+    for size in args.sizes:
+        results = []
+        for func in (legacy, store):
+            directory = tempfile.mkdtemp()
+            try:
+                results.append(func(*make_files(directory, size), args.ops))
+            finally:
+                shutil.rmtree(directory)
+        (legacy_toggle, legacy_add), (store_toggle, store_add) = results
+        print(f"{size:8} {legacy_toggle * 1000:14.2f} {store_toggle * 1000:13.2f} "
+              f"{legacy_add * 1000:11.2f} {store_add * 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
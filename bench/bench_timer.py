@@ -0,0 +1,62 @@
+"""Wakeups and fire-time jitter: 1 s polling loop vs the heap timer.
+
+The polling loop wakes up once per second whatever the number of jobs,
+the timer wakes up about once per job.
+
+Usage: python bench/bench_timer.py [--jobs 20] [--duration 30]
+"""
+import argparse, os, random, statistics, sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from timer import Timer
+
+
+def polling(due_times, duration):
+    # Same structure as the former schedule.run_pending() + time.sleep(1) loop
+    fired = []
+    pending = sorted(due_times)
+    wakeups = 0
+    end = time.time() + duration
+    while time.time() < end:
+        now = time.time()
+        while pending and pending[0] <= now:
+            fired.append(now - pending.pop(0))
+        wakeups += 1
+        time.sleep(1)
+    return wakeups, fired
+
+
+def heap_timer(due_times, duration):
+    fired = []
+    timer = Timer()
+    for i, due in enumerate(due_times):
+        timer.add(i, due, lambda due=due: fired.append(time.time() - due))
+    timer.add('end', time.time() + duration, timer.stop)
+    timer.run()
+    return timer.wakeups, fired
+
+
+def report(name, wakeups, fired, duration):
+    fired_ms = [f * 1000 for f in fired]
+    print(f"{name:8} wakeups={wakeups:5} ({wakeups / len(fired):6.2f} per job) "
+          f"jitter ms: mean={statistics.mean(fired_ms):7.2f} max={max(fired_ms):7.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    start = time.time() + 1
+    due_times = [start + random.uniform(0, args.duration - 2) for _ in range(args.jobs)]
+
+    report("polling", *polling(due_times, args.duration), args.duration)
+    start = time.time() + 1
+    due_times = [start + random.uniform(0, args.duration - 2) for _ in range(args.jobs)]
+    report("timer", *heap_timer(due_times, args.duration), args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Requests per second of the home and settings pages: former rendering
+(files parsed and the former templates rendered on each request) vs the
+pages cached per configuration version, and their ETag revalidation (304).
+The former templates are kept in bench/legacy_templates.
+
+Usage: python bench/bench_web.py [--commands 1000] [--requests 200]
+"""
+import argparse, json, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from jinja2 import FileSystemLoader
+from commands import CommandStore
+from devices import DeviceRegistry
+from jobs import JobRepository
+from storage import JsonStore, data_key
+from web import web
+
+
+def make_files(directory, size):
+    # The device is only displayed, the registry of the benchmark stays empty
+    data = [{'type': 'device', 'settings': {'devtype': '0x5213', 'host': '192.0.2.1',
+                                            'mac': '00:00:00:00:00:01', 'frequency': 433.92}},
+            {'type': 'location', 'settings': {'timezone': 'Europe/Paris', 'lat': 43.3, 'long': 5.36}}]
+    data += [{'name': f'cmd{i}', 'type': 'command',
+              'data': 'b2' + os.urandom(1200).hex()} for i in range(size)]
+    jobs = [{'name': f'job{i}', 'time': '08:00', 'enabled': True,
+             'parameters': {'action1': [f'cmd{i}'], 'delay': 0, 'action2': [],
+                            'weekday': True, 'weekend': True}} for i in range(50)]
+    data_file = os.path.join(directory, 'data.json')
+    jobs_file = os.path.join(directory, 'jobs.json')
+    with open(data_file, 'w') as f:
+        json.dump(data, f, indent=4)
+    with open(jobs_file, 'w') as f:
+        json.dump(jobs, f, indent=4)
+    return data_file, jobs_file
+
+
+def legacy_routes(server, data_file, jobs_file):
+    # Same work as the former handlers and templates, without any cache
+    templates = server.app.jinja_env.overlay(
+        loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), 'legacy_templates')))
+
+    def home():
+        with open(jobs_file, 'r') as f:
+            jobs_data = json.load(f)
+        with open(data_file, 'r') as f:
+            commands = [entry['name'] for entry in json.load(f) if entry['type'] == 'command']
+        return templates.get_template('index.html').render(jobs=jobs_data, commands=commands)
+
+    def settings():
+        with open(data_file, 'r') as f:
+            data = json.load(f)
+        return templates.get_template('settings.html').render(data=data)
+
+    server.app.add_url_rule('/legacy/', 'legacy_home', home)
+    server.app.add_url_rule('/legacy/settings', 'legacy_settings', settings)
+
+
+def measure(client, path, count, headers=None):
+    status = client.get(path, headers=headers).status_code
+    assert status in (200, 304), f"{path}: {status}"
+    start = time.perf_counter()
+    for _ in range(count):
+        client.get(path, headers=headers)
+    return status, count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        data_file, jobs_file = make_files(directory, args.commands)
+        data = JsonStore(data_file, data_key)
+        jobs = JobRepository(jobs_file)
+        commands = CommandStore()
+        commands.load(data.items())
+        server = web(data, jobs, DeviceRegistry(), commands, lambda changes: None, lambda changes: None)
+        legacy_routes(server, data_file, jobs_file)
+        client = server.app.test_client()
+
+        print(f"{args.commands} commands, {args.requests} requests per page")
+        for page, path in (('home', '/'), ('settings', '/settings')):
+            _, legacy = measure(client, '/legacy' + path, args.requests)
+            _, cached = measure(client, path, args.requests)
+            etag = client.get(path).headers['ETag']
+            status_304, revalidated = measure(client, path, args.requests, {'If-None-Match': etag})
+            print(f"{page:9} legacy {legacy:8.1f} req/s  cached {cached:8.1f} req/s"
+                  f"  revalidated ({status_304}) {revalidated:8.1f} req/s")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Local UDP stand-in for a Broadlink RM4 device, to test without hardware.
+
+Speaks enough of the protocol for the scheduler: discovery (hello),
+authentication, send_data, find_rf_packet/check_data (learning) and the
+frequency sweep. Received codes are recorded with their arrival time.
+
+Usage: python bench/emulator.py [--host 0.0.0.0] [--port 80] [--mac ec0baea05afb] [--devtype 0x5213]
+"""
+import argparse, os, socket, struct, threading, time
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Keys of the Broadlink protocol, the session key is sent by the authentication
+INIT_KEY = bytes.fromhex('097628343fe99e23765c1513accf8b02')
+INIT_VECT = bytes.fromhex('562e17996d093d28ddb3ba695a2e6f58')
+MAGIC = bytes.fromhex('5aa5aa555aa5aa55')
+
+# Packet types and RM4 commands
+AUTH = 0x65
+COMMAND = 0x6A
+SEND_DATA = 0x02
+ENTER_LEARNING = 0x03
+CHECK_DATA = 0x04
+SWEEP_FREQUENCY = 0x19
+CHECK_FREQUENCY = 0x1A
+FIND_RF_PACKET = 0x1B
+CANCEL_SWEEP = 0x1E
+CHECK_SENSORS = 0x24
+# Error codes
+NOT_SUPPORTED = -4
+READ_ERROR = -10
+
+
+def checksum(data):
+    return sum(data, 0xBEAF) & 0xFFFF
+
+
+def aes(key, payload, decrypt=False):
+    cipher = Cipher(algorithms.AES(key), modes.CBC(INIT_VECT))
+    context = cipher.decryptor() if decrypt else cipher.encryptor()
+    return context.update(payload) + context.finalize()
+
+
+class EmulatedDevice:
+    """Broadlink RM4 answering on (host, port), port 0 picks a free one.
+
+    'latency' delays every answer (s), 'offline' drops all the packets,
+    'learn_code' is returned by check_data 'learn_delay' seconds after
+    find_rf_packet.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, devtype=0x5213, mac='ec0baea05afb', name='Emulator'):
+        self.devtype = devtype
+        self.mac = bytes.fromhex(mac.replace(':', ''))
+        self.name = name
+        self.latency = 0
+        self.offline = False
+        self.learn_code = bytes.fromhex('b2000800010203040506070800000000')
+        self.learn_delay = 1
+        self.learn_at = None
+        # Session established by the last authentication
+        self.session_id = 0
+        self.key = INIT_KEY
+        # (time.time() of arrival, code) of each send_data
+        self.received = []
+        self.auths = 0
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                packet, client = self.sock.recvfrom(4096)
+            except OSError:
+                # Socket closed
+                return
+            if self.offline:
+                continue
+            try:
+                response = self.handle(packet)
+            except Exception as e:
+                print(f"Emulator: invalid packet from {client}: {e}")
+                continue
+            if response is None:
+                continue
+            if self.latency:
+                time.sleep(self.latency)
+            self.sock.sendto(response, client)
+
+    def handle(self, packet):
+        # Discovery packets are 0x30 bytes with the command 6
+        if len(packet) == 0x30 and packet[0x26] == 6:
+            return self.hello_response()
+        if len(packet) < 0x38 or packet[:0x08] != MAGIC:
+            return None
+
+        packet_type = int.from_bytes(packet[0x26:0x28], 'little')
+        if packet_type == AUTH:
+            payload = aes(INIT_KEY, bytes(packet[0x38:]), decrypt=True)
+            with self.lock:
+                self.auths += 1
+                self.session_id = int.from_bytes(os.urandom(4), 'little')
+                self.key = os.urandom(16)
+                response = self.session_id.to_bytes(4, 'little') + self.key
+            # The answer is encrypted with the initial key
+            return self.response(packet, response, key=INIT_KEY)
+        if packet_type == COMMAND:
+            payload = aes(self.key, bytes(packet[0x38:]), decrypt=True)
+            length, command = struct.unpack('<HI', payload[:6])
+            error, data = self.command(command, payload[6:length + 2])
+            if error:
+                return self.response(packet, b'', error)
+            return self.response(packet, struct.pack('<HI', len(data) + 4, command) + data)
+        return self.response(packet, b'', NOT_SUPPORTED)
+
+    def command(self, command, data):
+        # Returns (error code, answer data)
+        if command == SEND_DATA:
+            with self.lock:
+                self.received.append((time.time(), bytes(data)))
+            return 0, b''
+        if command in (ENTER_LEARNING, FIND_RF_PACKET):
+            self.learn_at = time.monotonic() + self.learn_delay
+            return 0, b''
+        if command == CHECK_DATA:
+            if self.learn_at is None or time.monotonic() < self.learn_at:
+                return READ_ERROR, b''
+            self.learn_at = None
+            return 0, self.learn_code
+        if command == CANCEL_SWEEP:
+            # Leaves the learning mode
+            self.learn_at = None
+            return 0, b''
+        if command == SWEEP_FREQUENCY:
+            return 0, b''
+        if command == CHECK_FREQUENCY:
+            return 0, b'\x01' + struct.pack('<I', 433920)
+        if command == CHECK_SENSORS:
+            return 0, bytes([21, 50, 45, 0])
+        return NOT_SUPPORTED, b''
+
+    def response(self, request, payload, error=0, key=None):
+        header = bytearray(0x38)
+        header[0x00:0x08] = MAGIC
+        header[0x22:0x24] = error.to_bytes(2, 'little', signed=True)
+        header[0x24:0x26] = self.devtype.to_bytes(2, 'little')
+        header[0x26:0x28] = (int.from_bytes(request[0x26:0x28], 'little') + 900).to_bytes(2, 'little')
+        header[0x28:0x2A] = request[0x28:0x2A]
+        header[0x2A:0x30] = self.mac[::-1]
+        header[0x30:0x34] = self.session_id.to_bytes(4, 'little')
+        if payload:
+            header[0x34:0x36] = checksum(payload).to_bytes(2, 'little')
+            payload = bytes(payload) + bytes((16 - len(payload)) % 16)
+            header.extend(aes(key or self.key, payload))
+        header[0x20:0x22] = checksum(header).to_bytes(2, 'little')
+        return bytes(header)
+
+    def hello_response(self):
+        response = bytearray(0x80)
+        response[0x26] = 7
+        response[0x34:0x36] = self.devtype.to_bytes(2, 'little')
+        response[0x3A:0x40] = self.mac[::-1]
+        name = self.name.encode()[:0x3E]
+        response[0x40:0x40 + len(name)] = name
+        response[0x20:0x22] = checksum(response).to_bytes(2, 'little')
+        return bytes(response)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default='0.0.0.0')
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--mac", default='ec0baea05afb')
+    parser.add_argument("--devtype", default='0x5213')
+    args = parser.parse_args()
+
+    device = EmulatedDevice(args.host, args.port, int(args.devtype, 0), args.mac)
+    print(f"Emulated device {args.mac} ({args.devtype}) on {device.address[0]}:{device.address[1]}")
+    device.serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Concurrency stress test of the web server: parallel add_job, toggle_job
+and remove_job posts, then checks that no update was lost, that jobs.json
+(reloaded from disk) matches the expected jobs and that the scheduler timer
+has an entry for exactly the enabled jobs.
+
+Usage: python bench/stress_web.py [--server pool] [--threads 8] [--clients 16] [--jobs 20]
+"""
+import argparse, contextlib, json, os, shutil, socket, sys, tempfile, time
+import urllib.error, urllib.parse, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from scheduler import Scheduler
+from jobs import JobRepository
+from storage import JsonStore, data_key
+from web import web, SERVERS
+
+# Times each client toggles the job shared by all the clients
+SHARED_TOGGLES = 5
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_files(directory):
+    data = [{'type': 'location', 'settings': {'timezone': 'Europe/Paris', 'lat': 43.3, 'long': 5.36}},
+            {'name': 'cmd', 'type': 'command', 'data': 'b2000400010203040000'}]
+    jobs = [{'name': 'shared', 'time': '08:00', 'enabled': True,
+             'parameters': {'action1': ['cmd'], 'delay': 0, 'action2': [],
+                            'weekday': True, 'weekend': True}}]
+    data_file = os.path.join(directory, 'data.json')
+    jobs_file = os.path.join(directory, 'jobs.json')
+    with open(data_file, 'w') as f:
+        json.dump(data, f, indent=4)
+    with open(jobs_file, 'w') as f:
+        json.dump(jobs, f, indent=4)
+    return data_file, jobs_file
+
+
+def post(url, form):
+    request = urllib.request.Request(url, urllib.parse.urlencode(form, doseq=True).encode())
+    # Redirects to the home page are not followed, only the post is measured
+    opener = urllib.request.build_opener(NoRedirect)
+    try:
+        opener.open(request, timeout=30).close()
+    except urllib.error.HTTPError as e:
+        if e.code != 302:
+            raise
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+
+def client(base, index, count):
+    # Add jobs, toggle them (disabled), remove the even ones, toggle the shared job
+    requests = 0
+    for i in range(count):
+        post(base + '/add_job', {'name': f'job-{index}-{i}', 'time': f'{i % 24:02d}:00',
+                                 'enabled': 'on', 'action1': 'cmd', 'days': 'mon'})
+        post(base + '/toggle_job', {'name': f'job-{index}-{i}'})
+        requests += 2
+        if i < SHARED_TOGGLES:
+            post(base + '/toggle_job', {'name': 'shared'})
+            requests += 1
+    for i in range(0, count, 2):
+        post(base + '/remove_job', {'name': f'job-{index}-{i}'})
+        requests += 1
+    return requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--server", choices=SERVERS[1:], default='pool')
+    parser.add_argument("--threads", type=int, default=8, help="web server worker threads")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--jobs", type=int, default=20, help="jobs added by each client")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        data_file, jobs_file = make_files(directory)
+        data = JsonStore(data_file, data_key)
+        jobs = JobRepository(jobs_file, compact_every=50)
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            scheduler = Scheduler(data, jobs)
+            scheduler.schedule_jobs()
+            server = web(data, jobs, scheduler.devices, scheduler.commands,
+                         scheduler.update_jobs, scheduler.update_data)
+            port = free_port()
+            server.start(args.server, args.threads, host='127.0.0.1', port=port)
+            base = f'http://127.0.0.1:{port}'
+            for _ in range(50):
+                try:
+                    urllib.request.urlopen(base + '/', timeout=1).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.clients) as pool:
+                requests = sum(pool.map(lambda i: client(base, i, args.jobs), range(args.clients)))
+            elapsed = time.perf_counter() - start
+            server.stop()
+            scheduler.close()
+
+        expected = {'shared': (args.clients * SHARED_TOGGLES) % 2 == 0}
+        for index in range(args.clients):
+            for i in range(1, args.jobs, 2):
+                expected[f'job-{index}-{i}'] = False
+
+        errors = []
+        model = {job['name']: job['enabled'] for job in jobs.items()}
+        if model != expected:
+            errors.append(f"model: {len(model)} jobs, expected {len(expected)}")
+        # Fresh load: jobs.json plus the write-ahead log if any
+        on_disk = {job['name']: job['enabled'] for job in JobRepository(jobs_file).items()}
+        if on_disk != model:
+            errors.append("jobs.json differs from the model")
+        scheduled = {key[1] for key in scheduler.timer.keys() if key != 'compact'}
+        if scheduled != {job['id'] for job in jobs.items() if job['enabled']}:
+            errors.append(f"timer entries {sorted(scheduled)} do not match the enabled jobs")
+
+        print(f"{args.server}, {args.threads} threads: {requests} posts from {args.clients} clients"
+              f" in {elapsed:.2f} s ({requests / elapsed:.0f} req/s)")
+        for error in errors:
+            print(f"FAILED: {error}")
+        if errors:
+            sys.exit(1)
+        print(f"OK: {len(expected)} jobs consistent in the model, jobs.json and the timer")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
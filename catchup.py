@@ -0,0 +1,74 @@
+import json, logging, os
+
+log = logging.getLogger('scheduler')
+
+# What to do with the runs missed while the scheduler was down, blocked or
+# when the wall clock jumped forward:
+#  skip      they are lost
+#  late      the last one runs once, if it is not older than the grace period
+#  coalesce  all of them run once, whatever their age
+POLICIES = ('skip', 'late', 'coalesce')
+DEFAULT_POLICY = 'late'
+# Default grace period of the 'late' policy (min)
+DEFAULT_GRACE = 30
+# A run starting later than this is a missed run (s)
+MISSED_AFTER = 60
+# Missed runs older than this are not looked for (s)
+MAX_CATCH_UP = 7 * 24 * 3600
+# Interval between the clock checks and watermark saves (s)
+CLOCK_CHECK = 30
+# Difference between the wall and monotonic clocks seen as a jump (s)
+CLOCK_JUMP = 30
+
+
+def catch_up_policy(parameters):
+    # (policy, grace in seconds) of a job
+    policy = parameters.get('catch_up', DEFAULT_POLICY)
+    if policy not in POLICIES:
+        raise ValueError(f"Invalid catch-up policy '{policy}'")
+    grace = parameters.get('grace', DEFAULT_GRACE)
+    if not isinstance(grace, (int, float)) or grace < 0:
+        raise ValueError(f"Invalid grace period {grace!r}")
+    return policy, grace * 60
+
+
+def catch_up_run(policy, grace, missed, now):
+    # Scheduled time of the missed run to execute now, None to skip them.
+    # 'missed' are the timestamps of the missed runs, in order.
+    if not missed or policy == 'skip':
+        return None
+    if policy == 'late' and now - missed[-1] > grace:
+        return None
+    return missed[-1]
+
+
+class Watermark:
+    """Wall time up to which the job runs were processed, saved in a file
+    next to jobs.json so the runs missed while down are found at startup.
+    It never goes back, even if the wall clock does.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.value = None
+        try:
+            with open(path, 'r') as f:
+                self.value = json.load(f)['watermark']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            log.warning("Invalid watermark file %s: %s", path, e)
+
+    def advance(self, value):
+        if self.value is not None and value <= self.value:
+            return
+        self.value = value
+        # Atomic, no fsync: losing the last update only makes the next
+        # startup look a bit further back
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'watermark': value}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning("Could not save the watermark: %s", e)
@@ -0,0 +1,219 @@
+import logging, threading
+
+log = logging.getLogger('commands')
+
+
+class CommandStore:
+    """Decoded RF/IR signals indexed by command name, ready to be sent.
+
+    Commands of data.json are decoded when loaded, commands of an optional
+    binary CommandLibrary are read from it on first use. data.json commands
+    take precedence over the library ones.
+    """
+
+    def __init__(self, library=None):
+        self.signals = {}   # name -> bytes sent to the device
+        self.sources = {}   # name -> hex string the signal was decoded from
+        self.targets = {}   # name -> device name, None for the default device
+        self.library = library
+        self.loaded = {}    # name -> bytes read from the library
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def to_hex(data):
+        # data.json stores either a hex string or a list of hex chunks
+        if isinstance(data, (bytes, bytearray)):
+            return data.hex()
+        if isinstance(data, list):
+            return ''.join(data)
+        return data
+
+    def load(self, json_data):
+        # Sync the store with the commands of a data.json content,
+        # only the entries that changed are decoded again
+        sources = {}
+        targets = {}
+        for itm in json_data:
+            if itm.get('type') == 'command' and itm['name'] not in sources:
+                sources[itm['name']] = self.to_hex(itm['data'])
+                targets[itm['name']] = itm.get('device')
+
+        changed = []
+        with self.lock:
+            for name in list(self.signals):
+                if name not in sources:
+                    del self.signals[name]
+                    del self.sources[name]
+                    changed.append(name)
+            self.targets = targets
+
+            for name, hex_data in sources.items():
+                if self.sources.get(name) == hex_data:
+                    continue
+                try:
+                    self.signals[name] = bytes.fromhex(hex_data)
+                    self.sources[name] = hex_data
+                except ValueError as e:
+                    log.warning("Invalid data for '%s': %s", name, e, extra={'command': name})
+                    self.signals.pop(name, None)
+                    self.sources.pop(name, None)
+                changed.append(name)
+        return changed
+
+    def update(self, name, data, device=None):
+        hex_data = self.to_hex(data)
+        signal = bytes.fromhex(hex_data)
+        with self.lock:
+            self.signals[name] = signal
+            self.sources[name] = hex_data
+            self.targets[name] = device
+
+    def remove(self, name):
+        with self.lock:
+            self.signals.pop(name, None)
+            self.sources.pop(name, None)
+            self.targets.pop(name, None)
+
+    def get(self, name):
+        signal = self.signals.get(name)
+        if signal is None and self.library is not None:
+            signal = self.loaded.get(name)
+            if signal is None:
+                signal = self.library.get(name)
+                if signal is not None:
+                    self.loaded[name] = signal
+        return signal
+
+    def device(self, name):
+        if name not in self.targets and self.library is not None:
+            meta = self.library.meta(name)
+            return meta.get('device') if meta else None
+        return self.targets.get(name)
+
+    def names(self):
+        names = list(self.signals)
+        if self.library is not None:
+            names += [name for name in self.library.names() if name not in self.signals]
+        return names
+
+    def summary(self, name):
+        # Size and type of a command, library payloads are not kept in memory
+        signal = self.signals.get(name)
+        if signal is None and self.library is not None:
+            signal = self.loaded.get(name) or self.library.get(name)
+        if signal is None:
+            return None
+        return {
+            'name': name,
+            'size': len(signal),
+            'kind': signal_kind(signal),
+            'device': self.device(name),
+            # Only in the binary library, which can not be modified
+            'library': name not in self.signals
+        }
+
+    def unknown(self, names):
+        # Names that have no signal, reported when loading the configuration
+        return [name for name in names if name and name not in self.signals
+                and (self.library is None or self.library.meta(name) is None)]
+
+
+# Broadlink pulse length unit (microseconds)
+PULSE_TICK = 32.84
+# Largest burst packet sent when a device does not set 'max_payload'
+MAX_PAYLOAD = 4096
+
+
+# Broadlink packet types
+KINDS = {0x26: 'IR', 0xb1: 'RF 433MHz', 0xb2: 'RF 433MHz', 0xd7: 'RF 315MHz'}
+
+
+def signal_kind(data):
+    return KINDS.get(data[0], f"0x{data[0]:02x}") if data else None
+
+
+def split_signal(data):
+    # Broadlink packet: type, repeat count, pulses length (LE), pulses,
+    # IR packets end with a 0x0d 0x05 trailer
+    if len(data) < 4 or len(data) < 4 + (data[2] | data[3] << 8):
+        raise ValueError(f"truncated packet of {len(data)} bytes")
+    length = data[2] | data[3] << 8
+    pulses = bytes(data[4:4 + length])
+    trailer = b''
+    if data[0] == 0x26 and pulses.endswith(b'\x0d\x05'):
+        pulses, trailer = pulses[:-2], pulses[-2:]
+    return data[0], data[1], pulses, trailer
+
+
+def decode_pulses(pulses):
+    # Pulse lengths in ticks, a 0 byte introduces a 16 bits big endian value
+    result = []
+    i = 0
+    while i < len(pulses):
+        value = pulses[i]
+        i += 1
+        if value == 0:
+            if i + 2 > len(pulses):
+                raise ValueError("truncated pulse")
+            value = pulses[i] << 8 | pulses[i + 1]
+            i += 2
+        result.append(value)
+    return result
+
+
+def encode_pulses(values):
+    result = bytearray()
+    for value in values:
+        value = min(value, 0xffff)
+        if value > 0xff:
+            result += bytes([0, value >> 8, value & 0xff])
+        else:
+            result.append(value)
+    return bytes(result)
+
+
+def add_gap(pulses, gap):
+    # Trains start with an 'on' pulse, so an even count ends with an 'off'
+    # pulse that is stretched, otherwise an 'off' pulse is appended
+    values = decode_pulses(pulses)
+    if values and len(values) % 2 == 0:
+        values[-1] += gap
+    else:
+        values.append(gap)
+    return encode_pulses(values)
+
+
+def compose_burst(signals, gap_ms, max_payload=MAX_PAYLOAD):
+    # Merge consecutive (name, data) signals into as few packets as possible.
+    # Only signals of the same type and repeat count are merged, 'gap_ms' of
+    # silence separates the merged codes. Returns a list of (names, data).
+    # A signal that can not be parsed is sent on its own, as it is.
+    gap = round(gap_ms * 1000 / PULSE_TICK)
+    packets = []
+    for name, data in signals:
+        try:
+            kind, repeat, pulses, trailer = split_signal(data)
+            decode_pulses(pulses)
+        except ValueError as e:
+            log.warning("Command '%s' not merged: %s", name, e, extra={'command': name})
+            packets.append(([name], bytes(data)))
+            continue
+        if packets:
+            names, last = packets[-1]
+            if isinstance(last, tuple) and last[:2] == (kind, repeat) and last[3] == trailer:
+                merged = add_gap(last[2], gap) + pulses
+                if 4 + len(merged) + len(trailer) <= max_payload:
+                    names.append(name)
+                    packets[-1] = (names, (kind, repeat, merged, trailer))
+                    continue
+        packets.append(([name], (kind, repeat, pulses, trailer)))
+
+    result = []
+    for names, packet in packets:
+        if isinstance(packet, bytes):
+            result.append((names, packet))
+            continue
+        kind, repeat, pulses, trailer = packet
+        body = pulses + trailer
+        result.append((names, bytes([kind, repeat, len(body) & 0xff, len(body) >> 8]) + body))
+    return result
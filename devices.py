@@ -0,0 +1,318 @@
+import logging, queue, threading, time
+import broadlink
+from collections import deque
+from concurrent.futures import Future
+
+from broadlink.const import DEFAULT_PORT
+
+from metrics import AUTHS, CIRCUIT_OPENS, REDISCOVERIES, SENDS, SEND_SECONDS, SEND_LATENESS
+
+log = logging.getLogger('devices')
+
+# Consecutive failures after which the device is considered down
+FAILURE_THRESHOLD = 3
+# Delay before trying a down device again, doubled on each failure (s)
+BACKOFF_MIN = 5
+BACKOFF_MAX = 300
+# Interval between the health checks of the devices (s)
+HEALTH_INTERVAL = 60
+# Sends held while a device is down are dropped after this delay (s)
+RETRY_MAX_AGE = 60
+
+
+class DeviceUnavailable(Exception):
+    pass
+
+
+class Device:
+    """A broadlink device with its own connection, send queue and worker thread.
+
+    Everything that talks to the device (authentication, sends, learning)
+    runs on the worker, so operations on one device are serialized while
+    different devices work in parallel.
+
+    A circuit breaker tracks the failures: after FAILURE_THRESHOLD
+    consecutive ones the device is 'open' and sends fail fast (or are held,
+    with the "on_failure": "retry" setting) instead of waiting for UDP
+    timeouts, until a trial after an exponential backoff succeeds.
+    """
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.connection = None
+        self.queue = queue.Queue()
+        # How late each send started compared to its scheduled time (seconds)
+        self.lateness = deque(maxlen=1000)
+        # Circuit breaker: 'closed' (working), 'open' (down)
+        self.state = 'closed'
+        self.failures = 0
+        self.retry_at = 0
+        self.last_ok = 0
+        self.checking = False
+        # Sends waiting for the device to come back: (name, data, due)
+        self.held = []
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def configure(self, settings):
+        # The connection is dropped, the worker authenticates again on next use
+        self.settings = settings
+        self.connection = None
+        # Try the new settings right away
+        self.retry_at = 0
+        self.submit(self.connect)
+
+    def connect(self):
+        # Only called from the worker thread
+        if self.connection is None:
+            settings = self.settings
+            devtype = int(settings['devtype'], 0)
+            host = settings['host']
+            # Clean the MAC address string before converting to hex
+            mac = bytearray.fromhex(settings['mac'].replace(':', '').strip())
+            log.info("Setup device '%s': %s, %s", self.name, hex(devtype), host, extra={'device': self.name})
+            # The port is only set for emulated devices (bench/emulator.py)
+            connection = broadlink.gendevice(devtype, (host, settings.get('port', DEFAULT_PORT)), mac)
+            try:
+                connection.auth()
+            except Exception:
+                AUTHS.inc(device=self.name, result='error')
+                raise
+            AUTHS.inc(device=self.name, result='ok')
+            self.connection = connection
+        return self.connection
+
+    def available(self):
+        # Closed circuit, or open one whose backoff is over (trial)
+        return self.state == 'closed' or time.monotonic() >= self.retry_at
+
+    def succeeded(self):
+        self.last_ok = time.monotonic()
+        if self.state == 'closed' and not self.failures:
+            return
+        if self.state == 'open':
+            log.info("Device '%s' is back", self.name, extra={'event': 'device_recovered', 'device': self.name})
+        self.state = 'closed'
+        self.failures = 0
+        held, self.held = self.held, []
+        for name, data, due in held:
+            if time.time() - due <= self.settings.get('retry_max_age', RETRY_MAX_AGE):
+                self.submit(self.transmit, name, data, due)
+            else:
+                log.warning("Dropped '%s' held for '%s' too long", name, self.name,
+                            extra={'device': self.name, 'command': name})
+                SENDS.inc(device=self.name, command=name, result='dropped')
+
+    def failed(self):
+        self.failures += 1
+        if self.failures < FAILURE_THRESHOLD:
+            return
+        backoff = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (self.failures - FAILURE_THRESHOLD))
+        self.retry_at = time.monotonic() + backoff
+        if self.state != 'open':
+            self.state = 'open'
+            CIRCUIT_OPENS.inc(device=self.name)
+        log.warning("Device '%s' down after %s failures, next try in %ss", self.name, self.failures, backoff,
+                    extra={'event': 'device_down', 'device': self.name})
+
+    def check(self):
+        # Health check: authenticate again, a round trip with the device
+        self.connection = None
+        self.connect()
+
+    def submit(self, func, *args):
+        future = Future()
+        self.queue.put((future, func, args))
+        return future
+
+    def stop(self):
+        self.queue.put((None, None, None))
+
+    def send(self, name, data, due):
+        return self.submit(self.transmit, name, data, due)
+
+    def transmit(self, name, data, due):
+        if not self.available():
+            if self.settings.get('on_failure', 'retry') == 'retry':
+                self.held.append((name, data, due))
+                SENDS.inc(device=self.name, command=name, result='held')
+                log.info("Device '%s' down, '%s' held", self.name, name, extra={'device': self.name, 'command': name})
+                return
+            SENDS.inc(device=self.name, command=name, result='unavailable')
+            raise DeviceUnavailable(f"Device '{self.name}' is down, '{name}' not sent")
+        late = time.time() - due
+        self.lateness.append(late)
+        SEND_LATENESS.observe(late, device=self.name)
+        log.info("Send %s on '%s' (%.0f ms late)", name, self.name, late * 1000,
+                 extra={'event': 'command_sent', 'device': self.name, 'command': name, 'late': late})
+        connection = self.connect()
+        start = time.perf_counter()
+        try:
+            connection.send_data(data)
+        except Exception:
+            SENDS.inc(device=self.name, command=name, result='error')
+            raise
+        SEND_SECONDS.observe(time.perf_counter() - start, device=self.name, command=name)
+        SENDS.inc(device=self.name, command=name, result='ok')
+
+    def worker(self):
+        while True:
+            future, func, args = self.queue.get()
+            if func is None:
+                return
+            try:
+                result = func(*args)
+            except DeviceUnavailable as e:
+                future.set_exception(e)
+            except Exception as e:
+                log.error("Device '%s' error: %s", self.name, e, extra={'event': 'device_error', 'device': self.name})
+                # Authenticate again on the next operation
+                self.connection = None
+                self.failed()
+                future.set_exception(e)
+            else:
+                if self.connection is not None:
+                    self.succeeded()
+                future.set_result(result)
+
+
+class DeviceRegistry:
+    """Devices declared in data.json, indexed by name"""
+
+    def __init__(self, on_moved=None):
+        # on_moved(name, host) stores the new address of a device found by discovery
+        self.on_moved = on_moved
+        self.devices = {}
+        self.default = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def device_name(entry):
+        # Unnamed devices are identified by their MAC address
+        return entry.get('name') or entry['settings']['mac']
+
+    def load(self, json_data):
+        # Sync the devices with data.json, only the devices whose settings
+        # changed are reconfigured
+        entries = {}
+        for itm in json_data:
+            if itm.get('type') == 'device':
+                entries.setdefault(self.device_name(itm), itm['settings'])
+
+        changed = []
+        with self.lock:
+            for name in list(self.devices):
+                if name not in entries:
+                    self.devices.pop(name).stop()
+                    changed.append(name)
+
+            for name, settings in entries.items():
+                device = self.devices.get(name)
+                if device is None:
+                    device = Device(name, settings)
+                    device.submit(device.connect)
+                    self.devices[name] = device
+                elif device.settings != settings:
+                    device.configure(settings)
+                else:
+                    continue
+                changed.append(name)
+
+            self.default = next(iter(entries), None)
+        return changed
+
+    def get(self, name=None):
+        return self.devices.get(name or self.default)
+
+    def stop(self, timeout=5):
+        # Pending operations are completed before the workers exit
+        with self.lock:
+            devices = list(self.devices.values())
+        for device in devices:
+            device.stop()
+        for device in devices:
+            device.thread.join(timeout)
+
+    def send(self, device_name, action, data, due):
+        device = self.get(device_name)
+        if device is None:
+            log.error("No device '%s' to send '%s'", device_name or 'default', action,
+                      extra={'event': 'device_error', 'device': device_name, 'command': action})
+            return None
+        return device.send(action, data, due)
+
+
+class HealthMonitor:
+    """Checks the devices in the background.
+
+    Idle devices are authenticated again every 'interval' seconds, down
+    devices when their backoff is over. Before trying a down device again,
+    it is looked for by MAC address with the DiscoveryService (if any) in
+    case its IP changed.
+    """
+
+    def __init__(self, registry, interval=HEALTH_INTERVAL, discovery=None):
+        self.registry = registry
+        self.interval = interval
+        self.discovery = discovery
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(1):
+            with self.registry.lock:
+                devices = list(self.registry.devices.values())
+            now = time.monotonic()
+            for device in devices:
+                try:
+                    self.check(device, now)
+                except Exception:
+                    log.exception("Health check of '%s' failed", device.name)
+
+    def check(self, device, now):
+        if device.checking:
+            return
+        if device.state == 'open':
+            if now < device.retry_at:
+                return
+            if self.rediscover(device):
+                # Reconfigured with the new address
+                return
+        elif now - device.last_ok < self.interval:
+            return
+        device.checking = True
+        future = device.submit(device.check)
+        future.add_done_callback(lambda future: setattr(device, 'checking', False))
+
+    def rediscover(self, device):
+        # Returns True if the device answered at another address
+        if self.discovery is None:
+            return False
+        self.discovery.refresh()
+        host = self.discovery.find(device.settings['mac'])
+        if host is None:
+            REDISCOVERIES.inc(device=device.name, result='not_found')
+            return False
+        if host == device.settings['host']:
+            REDISCOVERIES.inc(device=device.name, result='same_host')
+            return False
+
+        log.warning("Device '%s' moved from %s to %s", device.name, device.settings['host'], host,
+                    extra={'event': 'device_moved', 'device': device.name})
+        REDISCOVERIES.inc(device=device.name, result='moved')
+        if self.registry.on_moved is not None:
+            self.registry.on_moved(device.name, host)
+        else:
+            device.configure(dict(device.settings, host=host))
+        # Leave time to the connection to the new address before trying again
+        device.retry_at = time.monotonic() + BACKOFF_MIN
+        return True
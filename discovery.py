@@ -0,0 +1,158 @@
+import logging, socket, struct, threading, time
+import broadlink
+from concurrent.futures import ThreadPoolExecutor
+
+from broadlink.const import DEFAULT_PORT
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger('discovery')
+
+# Duration of a discovery on one interface (s)
+DISCOVER_TIMEOUT = 2
+# Interval between the background refreshes (s)
+REFRESH_INTERVAL = 300
+# Devices not seen for this long are forgotten (s)
+DEVICE_TTL = 900
+
+# Linux interface requests
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+IFF_UP = 0x1
+IFF_BROADCAST = 0x2
+IFF_LOOPBACK = 0x8
+
+
+def normalize_mac(mac):
+    return mac.replace(':', '').strip().lower()
+
+
+def interfaces():
+    # (address, broadcast address) of the IPv4 interfaces that are up,
+    # read from the interfaces themselves: no route to the internet needed
+    targets = []
+    if fcntl is not None and hasattr(socket, 'if_nameindex'):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            for _, name in socket.if_nameindex():
+                request = struct.pack('256s', name.encode()[:15])
+                try:
+                    flags = struct.unpack('H', fcntl.ioctl(s.fileno(), SIOCGIFFLAGS, request)[16:18])[0]
+                    if not flags & IFF_UP or flags & IFF_LOOPBACK:
+                        continue
+                    address = socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFADDR, request)[20:24])
+                    broadcast = '255.255.255.255'
+                    if flags & IFF_BROADCAST:
+                        broadcast = socket.inet_ntoa(fcntl.ioctl(s.fileno(), SIOCGIFBRDADDR, request)[20:24])
+                except OSError:
+                    # No IPv4 address
+                    continue
+                targets.append((address, broadcast))
+        return targets
+
+    # Other systems: addresses of the host name
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)}
+    except OSError:
+        addresses = set()
+    return [(address, '255.255.255.255') for address in sorted(addresses) if not address.startswith('127.')]
+
+
+class DiscoveryService:
+    """Broadlink devices found on the local networks, indexed by MAC.
+
+    All the interfaces are probed in parallel, in the background every
+    'interval' seconds or on demand, so readers get the cache without
+    waiting. 'targets' is a list of (local address, discovery address)
+    pairs, the interfaces and their broadcast address by default.
+    """
+
+    def __init__(self, targets=None, port=DEFAULT_PORT, timeout=DISCOVER_TIMEOUT,
+                 interval=REFRESH_INTERVAL, ttl=DEVICE_TTL):
+        self.targets = targets
+        self.port = port
+        self.timeout = timeout
+        self.interval = interval
+        self.ttl = ttl
+        # mac -> {'devtype', 'host', 'mac', 'name', 'seen'}
+        self.devices = {}
+        self.refreshed = None
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.interval:
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.refresh()
+            self.stopped.wait(self.interval)
+
+    def probe(self, local, address):
+        try:
+            return broadlink.discover(timeout=self.timeout, local_ip_address=local,
+                                      discover_ip_address=address, discover_ip_port=self.port)
+        except OSError as e:
+            log.warning("Discovery from %s failed: %s", local, e)
+            return []
+
+    def refresh(self):
+        # Probe all the targets in parallel, returns the devices found.
+        # A refresh already in progress is waited for instead of started again.
+        if not self.refreshing.acquire(blocking=False):
+            with self.refreshing:
+                return self.get()
+        try:
+            targets = self.targets if self.targets is not None else interfaces()
+            start = time.monotonic()
+            found = []
+            if targets:
+                with ThreadPoolExecutor(len(targets)) as pool:
+                    for devices in pool.map(lambda target: self.probe(*target), targets):
+                        found.extend(devices)
+
+            now = time.monotonic()
+            with self.lock:
+                for device in found:
+                    mac = ':'.join(format(x, '02x') for x in device.mac)
+                    self.devices[normalize_mac(mac)] = {
+                        'devtype': device.devtype,
+                        'host': device.host[0],
+                        'mac': mac,
+                        'name': device.name,
+                        'seen': now
+                    }
+                for key in [key for key, device in self.devices.items() if now - device['seen'] > self.ttl]:
+                    del self.devices[key]
+                self.refreshed = now
+            log.info("Discovered %s devices on %s interfaces in %.1fs", len(found), len(targets), now - start)
+            return self.get()
+        finally:
+            self.refreshing.release()
+
+    def refresh_async(self, max_age=0):
+        # Start a refresh in the background if the cache is older than max_age,
+        # returns True if a refresh is in progress
+        if self.refreshing.locked():
+            return True
+        if self.refreshed is not None and time.monotonic() - self.refreshed <= max_age:
+            return False
+        threading.Thread(target=self.refresh, daemon=True).start()
+        return True
+
+    def get(self):
+        with self.lock:
+            return sorted((dict(device) for device in self.devices.values()), key=lambda device: device['host'])
+
+    def find(self, mac):
+        with self.lock:
+            device = self.devices.get(normalize_mac(mac))
+            return device['host'] if device is not None else None
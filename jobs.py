@@ -0,0 +1,117 @@
+import bisect, collections, logging, threading, time, uuid
+
+from storage import JsonStore, job_key
+
+log = logging.getLogger('jobs')
+
+
+class DuplicateJobName(ValueError):
+    """A job with this name already exists"""
+
+
+def new_id():
+    return uuid.uuid4().hex[:12]
+
+
+class JobRepository(JsonStore):
+    """jobs.json with a stable id per job.
+
+    Jobs are indexed by id and by name, names are unique. The scheduler
+    records the next fire time of each job, indexed by time for the
+    "what runs next" queries. Jobs without an id (files written before the
+    ids, jobs added by hand) get one when loaded, and the file is rewritten.
+    """
+
+    def __init__(self, path, compact_every=100):
+        # id -> job, id -> position in items(), name -> id
+        self.by_id = {}
+        self.positions = {}
+        self.names = {}
+        # Sorted (timestamp, id) of the scheduled jobs, and timestamp by id
+        self.fire_times = []
+        self.next_fire = {}
+        self.schedule_lock = threading.Lock()
+        super().__init__(path, job_key, compact_every)
+
+    def read(self):
+        entries, replayed = super().read()
+        return entries, replayed + self.assign_ids(entries)
+
+    def assign_ids(self, entries):
+        # Give an id to the jobs without one (or a copy of another job's id),
+        # returns the number of jobs changed
+        seen = set()
+        assigned = 0
+        for i, job in enumerate(entries):
+            if not job.get('id') or job['id'] in seen:
+                job = {'id': new_id(), **{key: value for key, value in job.items() if key != 'id'}}
+                entries[i] = job
+                assigned += 1
+            seen.add(job['id'])
+        if assigned:
+            log.info("Assigned ids to %s jobs of %s", assigned, self.path)
+        return assigned
+
+    def set_entries(self, entries):
+        super().set_entries(entries)
+        self.by_id = {job_key(job): job for job in self.entries}
+        self.positions = {job_key(job): i for i, job in enumerate(self.entries)}
+        names = {}
+        for job in self.entries:
+            if job['name'] in names:
+                log.warning("Several jobs are named '%s'", job['name'], extra={'job': job['name']})
+                continue
+            names[job['name']] = job_key(job)
+        self.names = names
+        # Removed jobs do not run anymore
+        for key in [key for key in self.next_fire if key not in self.by_id]:
+            self.set_next(key, None)
+
+    def check(self, entries):
+        # New jobs get an id, a job can not take the name of another one
+        self.assign_ids(entries)
+        names = collections.Counter(job['name'] for job in entries)
+        for job in entries:
+            if names[job['name']] > 1 and self.get(job['id']) != job:
+                raise DuplicateJobName(job['name'])
+
+    def get(self, key):
+        return self.by_id.get(key)
+
+    def position(self, key):
+        # Index of the job in items() and in the list given to modify(),
+        # to be called under the lock
+        return self.positions.get(key)
+
+    def find(self, name):
+        return self.by_id.get(self.names.get(name))
+
+    def set_next(self, key, when):
+        # Next fire time (timestamp) of a job, None when it is not scheduled
+        with self.schedule_lock:
+            old = self.next_fire.pop(key, None)
+            if old is not None:
+                del self.fire_times[bisect.bisect_left(self.fire_times, (old, key))]
+            if when is not None:
+                self.next_fire[key] = when
+                bisect.insort(self.fire_times, (when, key))
+
+    def first_fire(self):
+        # Earliest next fire time of the scheduled jobs, None if there is none
+        with self.schedule_lock:
+            return self.fire_times[0][0] if self.fire_times else None
+
+    def upcoming(self, minutes, now=None):
+        # (timestamp, job) of the jobs firing in the next 'minutes', in order
+        now = time.time() if now is None else now
+        end = now + minutes * 60
+        upcoming = []
+        with self.schedule_lock:
+            for i in range(bisect.bisect_left(self.fire_times, (now,)), len(self.fire_times)):
+                when, key = self.fire_times[i]
+                if when > end:
+                    break
+                job = self.get(key)
+                if job is not None:
+                    upcoming.append((when, job))
+        return upcoming
@@ -0,0 +1,131 @@
+import logging, threading, time, uuid
+
+from broadlink.exceptions import ReadError, StorageError
+
+from metrics import LEARN_SECONDS
+
+log = logging.getLogger('learning')
+
+# Interval between two checks of the captured data (s)
+POLL_INTERVAL = 0.3
+# Finished sessions are forgotten after this delay (s)
+SESSION_TTL = 600
+
+
+class LearnSession:
+    """Capture of one RF code, run on the worker of the device.
+
+    The device worker (and so its sends) is only held while the device is
+    in learning mode, which ends as soon as a code is received, on timeout
+    or when cancelled.
+    """
+
+    def __init__(self, name, device, frequency, timeout, device_name=None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.device = device
+        # Device name stored with the command, None for the default device
+        self.device_name = device_name
+        self.frequency = frequency
+        self.timeout = timeout
+        self.state = 'waiting'
+        self.message = 'Waiting for the device'
+        self.data = None
+        self.cancelled = threading.Event()
+        self.started = None
+        self.finished = None
+
+    def capture(self):
+        self.state = 'capturing'
+        self.message = 'Please send the RF signal now...'
+        self.started = time.monotonic()
+        connection = self.device.connect()
+        connection.find_rf_packet(self.frequency)
+        # Woken up as soon as cancelled
+        while not self.cancelled.wait(POLL_INTERVAL) and time.monotonic() - self.started < self.timeout:
+            try:
+                data = connection.check_data()
+            except (ReadError, StorageError):
+                # Nothing received yet
+                continue
+            if data:
+                return bytes(data)
+        # Nothing received: the device is taken out of learning mode
+        try:
+            connection.cancel_sweep_frequency()
+        except Exception as e:
+            log.warning("Could not stop learning on '%s': %s", self.device.name, e,
+                        extra={'device': self.device.name})
+        return None
+
+    def status(self):
+        remaining = None
+        if self.state == 'capturing':
+            remaining = max(0, self.timeout - (time.monotonic() - self.started))
+        return {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'success': self.state == 'learned',
+            'message': self.message,
+            'remaining': remaining
+        }
+
+
+class LearnManager:
+    """Learning sessions, started in the background and polled by the UI"""
+
+    def __init__(self, on_learned):
+        # on_learned(session) stores the learned code
+        self.on_learned = on_learned
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def start(self, name, device, frequency, timeout=30, device_name=None):
+        session = LearnSession(name, device, frequency, timeout, device_name)
+        with self.lock:
+            self.purge()
+            self.sessions[session.id] = session
+        log.info("Learning RF command '%s' at %sMHz on '%s'...", name, frequency, device.name,
+                 extra={'event': 'learn_started', 'command': name, 'device': device.name})
+        future = device.submit(session.capture)
+        future.add_done_callback(lambda future: self.finish(session, future))
+        return session
+
+    def finish(self, session, future):
+        try:
+            session.data = future.result()
+            if session.data is not None:
+                self.on_learned(session)
+                session.state = 'learned'
+                session.message = f"Command '{session.name}' learned successfully"
+            elif session.cancelled.is_set():
+                session.state = 'cancelled'
+                session.message = 'Learning cancelled'
+            else:
+                session.state = 'timeout'
+                session.message = 'No RF signal received'
+        except Exception as e:
+            session.state = 'error'
+            session.message = f"Error learning command: {e}"
+        session.finished = time.monotonic()
+        if session.started is not None:
+            LEARN_SECONDS.observe(session.finished - session.started,
+                                  device=session.device.name, result=session.state)
+        log.info("Learning '%s': %s", session.name, session.message,
+                 extra={'event': 'learn_finished', 'command': session.name, 'state': session.state})
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def cancel(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.cancelled.set()
+        return session
+
+    def purge(self):
+        now = time.monotonic()
+        for session_id, session in list(self.sessions.items()):
+            if session.finished is not None and now - session.finished > SESSION_TTL:
+                del self.sessions[session_id]
@@ -0,0 +1,141 @@
+import argparse, json, mmap, os
+import threading
+
+# Index format version
+VERSION = 1
+
+
+class CommandLibrary:
+    """Binary command library: a small JSON index and a blob of raw payloads.
+
+    '<path>.idx' lists the data.json entries in order, the 'data' of the
+    commands is replaced by the offset and length of their payload in
+    '<path>.bin'. Only the index is read when the library is opened, the
+    blob is memory-mapped on first access.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.blob_path = path + '.bin'
+        self.blob = None
+        self.lock = threading.Lock()
+        with open(self.index_path, 'r') as f:
+            index = json.load(f)
+        if index.get('version') != VERSION:
+            raise ValueError(f"Unsupported library version {index.get('version')}")
+        self.entries = index['entries']
+        self.commands = {}
+        for entry in self.entries:
+            if entry.get('type') == 'command':
+                self.commands.setdefault(entry['name'], entry)
+
+    def names(self):
+        return list(self.commands)
+
+    def meta(self, name):
+        return self.commands.get(name)
+
+    def get(self, name):
+        entry = self.commands.get(name)
+        if entry is None:
+            return None
+        if self.blob is None:
+            with self.lock:
+                if self.blob is None:
+                    self.blob = self.map_blob()
+        location = entry['data']
+        return self.blob[location['offset']:location['offset'] + location['length']]
+
+    def map_blob(self):
+        with open(self.blob_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.blob = None
+
+
+def import_json(json_path, path):
+    # Convert a data.json file into a binary library
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+
+    entries = []
+    offset = 0
+    with open(path + '.bin.tmp', 'wb') as blob:
+        for entry in data:
+            if entry.get('type') != 'command':
+                entries.append(entry)
+                continue
+            entry = dict(entry)
+            hex_data = entry['data']
+            location = {}
+            # Keep what is needed to write the same JSON back
+            if isinstance(hex_data, list):
+                location['chunks'] = [len(chunk) for chunk in hex_data]
+                hex_data = ''.join(hex_data)
+            if hex_data != hex_data.lower():
+                location['upper'] = True
+            payload = bytes.fromhex(hex_data)
+            blob.write(payload)
+            location['offset'] = offset
+            location['length'] = len(payload)
+            offset += len(payload)
+            entry['data'] = location
+            entries.append(entry)
+
+    with open(path + '.idx.tmp', 'w') as f:
+        json.dump({'version': VERSION, 'entries': entries}, f)
+    os.replace(path + '.bin.tmp', path + '.bin')
+    os.replace(path + '.idx.tmp', path + '.idx')
+    return len(entries)
+
+
+def export_json(path, json_path):
+    # Convert a binary library back into a data.json file
+    library = CommandLibrary(path)
+    data = []
+    for entry in library.entries:
+        if entry.get('type') != 'command':
+            data.append(entry)
+            continue
+        entry = dict(entry)
+        location = entry['data']
+        hex_data = library.get(entry['name']).hex()
+        if location.get('upper'):
+            hex_data = hex_data.upper()
+        if 'chunks' in location:
+            split = []
+            for length in location['chunks']:
+                split.append(hex_data[:length])
+                hex_data = hex_data[length:]
+            hex_data = split
+        entry['data'] = hex_data
+        data.append(entry)
+    library.close()
+
+    with open(json_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    return len(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert data.json to/from a binary command library")
+    parser.add_argument("action", choices=['import', 'export'])
+    parser.add_argument("json", help="data.json file")
+    parser.add_argument("library", help="library path, without the .idx/.bin extension")
+    args = parser.parse_args(argv)
+
+    if args.action == 'import':
+        count = import_json(args.json, args.library)
+    else:
+        count = export_json(args.library, args.json)
+    print(f"{count} entries converted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import json, logging, logging.handlers, queue, sys, time
+
+# Components whose level can be set separately (logger names)
+COMPONENTS = ('scheduler', 'jobs', 'scenes', 'devices', 'discovery', 'web', 'storage', 'watcher', 'solar', 'learning', 'timer', 'commands')
+FORMATS = ('json', 'text')
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+# Attributes of every record, the other ones are the fields of the event (extra=)
+RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'monotonic', 'taskName'}
+
+
+class BufferedHandler(logging.handlers.QueueHandler):
+    """Queues the records as they are: the message is formatted and written
+    by the listener thread, not by the thread that logs (timer, device
+    workers). Records are not copied, so the arguments must not be modified
+    after the call.
+    """
+
+    def prepare(self, record):
+        record.monotonic = time.monotonic()
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: wall and monotonic timestamps, level,
+    component, message and the fields given with extra=
+    """
+
+    def format(self, record):
+        event = {
+            'time': round(record.created, 6),
+            'monotonic': round(getattr(record, 'monotonic', 0), 6),
+            'level': record.levelname,
+            'component': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED:
+                event[key] = value
+        if record.exc_info:
+            event['exception'] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+def parse_levels(text):
+    # "devices=DEBUG,web=WARNING" -> [('devices', 'DEBUG'), ('web', 'WARNING')]
+    levels = []
+    for item in filter(None, text.split(',')):
+        component, _, level = item.partition('=')
+        level = level.strip().upper()
+        if component.strip() not in COMPONENTS or not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Invalid component level '{item}'")
+        levels.append((component.strip(), level))
+    return levels
+
+
+def setup(level='INFO', levels=(), fmt='json', path=None, max_bytes=10 * 1024 * 1024, backups=5):
+    # Route all the logs through a queue to stdout and, optionally, a
+    # rotating file. Returns the listener, to be stopped on exit.
+    formatter = JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if path:
+        handlers.append(logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Process information is never logged, skip it when creating the records
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers)
+    root = logging.getLogger()
+    root.handlers[:] = [BufferedHandler(records)]
+    root.setLevel(level.upper())
+    for component, component_level in levels:
+        logging.getLogger(component).setLevel(component_level)
+    listener.start()
+    return listener
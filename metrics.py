@@ -0,0 +1,112 @@
+import bisect, copy, threading
+
+# Default histogram buckets (s)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# All the metrics, in the order they are rendered
+REGISTRY = []
+
+
+class Metric:
+    """Base of the counters and histograms.
+
+    Recording only updates a dict entry under a lock, the text format is
+    built when /metrics is scraped.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def label_text(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in pairs)
+        return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            values = copy.deepcopy(list(self.values.items()))
+        for key, value in values:
+            lines.extend(self.samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, key, value):
+        yield f"{self.name}{self.label_text(key)} {value}"
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # Count per bucket (last one is +Inf), sum, count
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self, key, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            yield f"{self.name}_bucket{self.label_text(key, ('le', str(bound)))} {cumulative}"
+        yield f"{self.name}_sum{self.label_text(key)} {total}"
+        yield f"{self.name}_count{self.label_text(key)} {count}"
+
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+SENDS = Counter('broadlink_sends_total', "Sends to the devices by result", ('device', 'command', 'result'))
+SEND_SECONDS = Histogram('broadlink_send_seconds', "Round trip time of device.send_data", ('device', 'command'))
+SEND_LATENESS = Histogram('broadlink_send_lateness_seconds', "Delay between the scheduled time of a send "
+                          "and its start on the device worker", ('device',))
+AUTHS = Counter('broadlink_auths_total', "Device authentications by result", ('device', 'result'))
+CIRCUIT_OPENS = Counter('broadlink_circuit_opens_total', "Devices detected down", ('device',))
+REDISCOVERIES = Counter('broadlink_rediscoveries_total', "Discoveries of a down device by result", ('device', 'result'))
+JOB_RUNS = Counter('broadlink_job_runs_total', "Job runs", ('job',))
+JOB_OFFSET = Histogram('broadlink_job_fire_offset_seconds', "Actual minus scheduled fire time of the jobs", ('job',))
+JOB_CATCH_UPS = Counter('broadlink_job_catch_ups_total', "Missed job runs by catch-up policy and result",
+                        ('job', 'policy', 'result'))
+CLOCK_JUMPS = Counter('broadlink_clock_jumps_total', "Wall clock jumps detected with the monotonic clock", ('direction',))
+RELOAD_SECONDS = Histogram('broadlink_config_reload_seconds', "Duration of the configuration file reloads", ('file',))
+LEARN_SECONDS = Histogram('broadlink_learn_seconds', "Duration of the learning sessions by result",
+                          ('device', 'result'), buckets=(1, 2, 5, 10, 15, 20, 30, 60, 120))
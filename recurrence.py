@@ -0,0 +1,133 @@
+import datetime, functools, re
+
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+# Masks of the days, bit 0 is Monday
+WEEKDAYS = 0b0011111
+WEEKEND = 0b1100000
+# How far the next run is searched (days)
+MAX_DAYS = 2 * 366
+# Sun events of the job times, offsets in minutes
+SUN_TIME = re.compile(r'(sunset|sunrise)([-+]\d+)?')
+SUN_EVENTS = {'sunset': 'dusk', 'sunrise': 'dawn'}
+
+
+def parse_time(text):
+    # 'HH:MM', 'HH:MM:SS' -> (None, time), 'sunset[+-offset]' or
+    # 'sunrise[+-offset]' -> ('dusk' or 'dawn', offset in minutes)
+    if not isinstance(text, str):
+        raise ValueError(f"Invalid time {text!r}")
+    match = SUN_TIME.fullmatch(text.strip())
+    if match:
+        return SUN_EVENTS[match.group(1)], int(match.group(2) or 0)
+    fmt = '%H:%M:%S' if text.count(':') == 2 else '%H:%M'
+    try:
+        return None, datetime.datetime.strptime(text.strip(), fmt).time()
+    except ValueError:
+        raise ValueError(f"Invalid time '{text}', expected HH:MM or sunset/sunrise[+-minutes]") from None
+
+
+def parse_date(text):
+    # 'YYYY-MM-DD' is a date, 'MM-DD' the same day every year as a (month, day) tuple
+    parts = [int(part) for part in text.strip().split('-')]
+    if len(parts) == 3:
+        return datetime.date(*parts)
+    if len(parts) == 2:
+        # Validated with a leap year, so 02-29 is accepted
+        datetime.date(2000, *parts)
+        return tuple(parts)
+    raise ValueError(f"Invalid date '{text}'")
+
+
+def day_mask(parameters):
+    # 'days': ["mon", "sat"...] or, in older jobs, the 'weekday'/'weekend' booleans
+    if 'days' in parameters:
+        mask = 0
+        for day in parameters['days']:
+            if day not in DAYS:
+                raise ValueError(f"Invalid day '{day}'")
+            mask |= 1 << DAYS.index(day)
+        return mask
+    return (WEEKDAYS if parameters.get('weekday', True) else 0) | (WEEKEND if parameters.get('weekend', True) else 0)
+
+
+class Recurrence:
+    """Days a job runs: a set of days of the week, optional periods and
+    excluded dates.
+
+    Periods are (from, until) pairs, inclusive, of dates or of yearly
+    (month, day) tuples which can wrap the end of the year (11-01 to 03-31).
+    Excluded dates are dates or yearly (month, day) tuples.
+    """
+
+    def __init__(self, days=WEEKDAYS | WEEKEND, periods=(), exclude=()):
+        self.days = days
+        self.periods = tuple(periods)
+        self.exclude = frozenset(exclude)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        periods = tuple(tuple(period) for period in parameters.get('periods', ()))
+        return compile_recurrence(day_mask(parameters), periods, tuple(parameters.get('except', ())))
+
+    def in_period(self, date, period):
+        start, end = period
+        if isinstance(start, datetime.date):
+            return start <= date <= end
+        day = (date.month, date.day)
+        if start <= end:
+            return start <= day <= end
+        return day >= start or day <= end
+
+    def period_start(self, date, period):
+        # First day of the period on or after 'date', None if it is over
+        start = period[0]
+        if isinstance(start, datetime.date):
+            return max(start, date) if date <= period[1] else None
+        for year in (date.year, date.year + 1):
+            try:
+                day = datetime.date(year, *start)
+            except ValueError:
+                # 02-29 of a year that is not a leap year
+                day = datetime.date(year, 3, 1)
+            if day >= date:
+                return day
+        return None
+
+    def matches(self, date):
+        return ((self.days >> date.weekday()) & 1
+                and (not self.periods or any(self.in_period(date, period) for period in self.periods))
+                and date not in self.exclude and (date.month, date.day) not in self.exclude)
+
+    def dates(self, start, days=MAX_DAYS):
+        # Matching dates from 'start', searched for 'days' days.
+        # Days outside of the periods are skipped, not tested one by one.
+        if not self.days:
+            return
+        date = start
+        end = start + datetime.timedelta(days=days)
+        while date < end:
+            if self.periods and not any(self.in_period(date, period) for period in self.periods):
+                starts = [day for day in (self.period_start(date, period) for period in self.periods)
+                          if day is not None]
+                if not starts:
+                    return
+                date = max(min(starts), date + datetime.timedelta(days=1))
+                continue
+            if self.matches(date):
+                yield date
+            date += datetime.timedelta(days=1)
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_recurrence(days, periods, exclude):
+    # Jobs with the same days share one Recurrence, rebuilding the schedule
+    # of thousands of jobs parses each distinct set of days once
+    parsed = []
+    for period in periods:
+        if len(period) != 2:
+            raise ValueError(f"Invalid period '{':'.join(period)}', expected from:until")
+        start, end = parse_date(period[0]), parse_date(period[1])
+        if type(start) != type(end):
+            raise ValueError(f"Period {start} to {end} mixes a date and a yearly day")
+        parsed.append((start, end))
+    return Recurrence(days, parsed, [parse_date(date) for date in exclude])
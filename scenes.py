@@ -0,0 +1,90 @@
+import logging
+
+log = logging.getLogger('scenes')
+
+# Interval between two steps of a scene when a step has no offset (s)
+STEP_GAP = 0.5
+
+
+class SceneError(ValueError):
+    """Unknown scene, cycle between scenes or invalid step"""
+
+
+class SceneBook:
+    """Named scenes of data.json compiled into flat timelines.
+
+    A scene is a list of steps, each one a command or another scene, at an
+    'offset' (s) from the start of the scene. A step without an offset
+    comes 'gap' seconds (STEP_GAP by default) after the end of the previous
+    one. Scenes are compiled when loaded into sorted tuples of
+    (offset, command, device, payload), jobs only walk them.
+
+        {"type": "scene", "name": "morning", "gap": 0.5, "steps": [
+            {"command": "bedroom.up"},
+            {"command": "kitchen.up", "offset": 2},
+            {"scene": "lights", "offset": 10}
+        ]}
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.definitions = {}
+        self.timelines = {}
+
+    def load(self, json_data):
+        # Compile all the scenes again: commands or devices may have changed
+        self.definitions = {entry['name']: entry for entry in json_data if entry.get('type') == 'scene'}
+        self.timelines = {}
+        for name in self.definitions:
+            try:
+                self.timeline(name)
+            except SceneError as e:
+                log.warning("Invalid scene '%s': %s", name, e, extra={'scene': name})
+
+    def names(self):
+        return sorted(self.definitions)
+
+    def timeline(self, name):
+        timeline = self.timelines.get(name)
+        if timeline is None:
+            timeline = self.compile(name, ())
+        return timeline
+
+    def compile(self, name, stack):
+        # 'stack' is the chain of scenes being compiled, to detect cycles
+        if name in stack:
+            raise SceneError(f"cycle {' -> '.join(stack + (name,))}")
+        if name in self.timelines:
+            return self.timelines[name]
+        scene = self.definitions.get(name)
+        if scene is None:
+            raise SceneError(f"unknown scene '{name}'")
+
+        gap = scene.get('gap', STEP_GAP)
+        timeline = []
+        offset = 0
+        for step in scene.get('steps', []):
+            at = step.get('offset', offset)
+            if not isinstance(at, (int, float)) or at < 0:
+                raise SceneError(f"invalid offset {at!r} in '{name}'")
+            if 'scene' in step:
+                nested = self.compile(step['scene'], stack + (name,))
+                timeline.extend((at + nested_offset, *send) for nested_offset, *send in nested)
+                # The next step follows the last one of the nested scene
+                at += nested[-1][0] if nested else 0
+            elif 'command' in step:
+                command = step['command']
+                data = self.commands.get(command)
+                if data is None:
+                    log.error("Data not found for '%s' in scene '%s'", command, name,
+                              extra={'command': command, 'scene': name})
+                else:
+                    timeline.append((at, command, self.commands.device(command), data))
+            else:
+                raise SceneError(f"step without command or scene in '{name}'")
+            offset = at + gap
+
+        # Steps with an offset can be listed in any order
+        timeline.sort(key=lambda send: send[0])
+        self.timelines[name] = tuple(timeline)
+        return self.timelines[name]
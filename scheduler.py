@@ -1,237 +1,503 @@
 import argparse
-import json, schedule
-import time, re, datetime, pytz
-import threading
-import broadlink
-
-from broadlink.const import DEFAULT_PORT
-from astral import LocationInfo
-from astral.sun import sun
-from web import web 
+import logging, os, time, datetime, signal
+import functools, itertools
+
+from catchup import (Watermark, catch_up_policy, catch_up_run, CLOCK_CHECK, CLOCK_JUMP,
+                     MAX_CATCH_UP, MISSED_AFTER)
+from commands import CommandStore, MAX_PAYLOAD, compose_burst
+from devices import DeviceRegistry, HealthMonitor, HEALTH_INTERVAL
+from discovery import DiscoveryService
+from jobs import JobRepository
+from library import CommandLibrary
+from logs import FORMATS, parse_levels, setup as setup_logs
+from metrics import JOB_RUNS, JOB_OFFSET, JOB_CATCH_UPS, CLOCK_JUMPS, RELOAD_SECONDS
+from recurrence import Recurrence, parse_time
+from scenes import SceneBook, SceneError, STEP_GAP
+from solar import SolarTable
+from storage import JsonStore, data_key
+from timer import Timer
+from watcher import FileWatcher
+from web import web, SERVERS
+
+log = logging.getLogger('scheduler')
+
+# Default silence between the codes of a burst (ms)
+BURST_GAP = 100
+# Interval between the JSON files compactions (s)
+COMPACT_INTERVAL = 60
+# Jobs without days or periods
+EVERY_DAY = Recurrence()
 
 class Scheduler:
-    def __init__(self, data_file, jobs_file):
-        self.data_file = data_file
-        self.jobs_file = jobs_file
-        self.json_data = self.read_data_from_json(self.data_file)
-        self.json_jobs = self.read_data_from_json(self.jobs_file)
-        self.suntime = self.get_sun()
-        self.device = None
-        self.scheduler_reset = threading.Event()
-        if not self.setup_device():
-            print("Failed to initialize device, will try later", flush=True)
-        
-    def setup_device(self):
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-            for item in data:
-                if item['type'] == "device":
-                    settings = item['settings']
-                    devtype = int(settings['devtype'], 0)
-                    host = settings['host']
-                    # Clean the MAC address string before converting to hex
-                    mac_str = settings['mac'].replace(':', '').strip()
-                    try:
-                        mac = bytearray.fromhex(mac_str)
-                        self.device = broadlink.gendevice(devtype, (host, DEFAULT_PORT), mac)
-                        self.device.auth()
-                    except Exception as e:
-                        print(f"Failed to setup device: {e}", flush=True)
-                        self.device = None
-                        return False
-                    return True
-        return False
+    def __init__(self, data, jobs, library=None, health_interval=HEALTH_INTERVAL):
+        # JsonStore of data.json and JobRepository of jobs.json, shared with the web server
+        self.data = data
+        self.jobs = jobs
+        self.json_data = self.data.items()
+        self.json_jobs = self.jobs.items()
+        self.commands = CommandStore(library)
+        self.commands.load(self.json_data)
+        self.scenes = SceneBook(self.commands)
+        self.scenes.load(self.json_data)
+        # Job id -> (job, timeline of its sends)
+        self.timelines = {}
+        self.solar = self.get_solar()
+        self.devices = DeviceRegistry(self.device_moved)
+        self.devices.load(self.json_data)
+        self.discovery = DiscoveryService()
+        self.monitor = HealthMonitor(self.devices, health_interval, self.discovery)
+        self.timer = Timer()
+        # Last processed wall time, saved next to jobs.json
+        self.watermark = Watermark(self.jobs.path + '.state')
+        # (wall, monotonic) time of the last clock check
+        self.clock_ref = None
+        self.watcher = FileWatcher([self.data.path, self.jobs.path], self.file_changed)
 
     def run(self):
-        while not self.device and not self.setup_device():
-            print("Failed to initialize device, try agin", flush=True)
-            time.sleep(10)
-
-        while True:
-            # Update data from files
-            self.json_data = self.read_data_from_json(self.data_file)
-            self.json_jobs = self.read_data_from_json(self.jobs_file)
-            self.schedule_jobs()
-
-            # Run scheduler
-            while not self.scheduler_reset.is_set():
-                schedule.run_pending()
-                time.sleep(1)
-
-            # Cancel all jobs before exiting
-            schedule.clear()
-            self.scheduler_reset.clear()
-            print("Scheduler restart", flush=True)
-
-    def setup_dev(self):
-        for itm in self.json_data:
-            if itm['type'] == "device":
-                itm = itm['settings']
-                devtype = int(itm['devtype'], 0)
-                host = itm['host']
-                mac = bytearray.fromhex(itm['mac'])
-
-                print(f"Setup {devtype}, {host}, {mac}", flush=True)
-                dev = broadlink.gendevice(devtype, (host, DEFAULT_PORT), mac)
-                dev.auth()
-                return dev
-
-        print ("Setup data not found", flush=True)
-        return None
-
-    def get_sun(self):
+        # Runs missed while the scheduler was not running
+        self.clock_ref = (time.time(), time.monotonic())
+        if self.watermark.value is not None:
+            self.catch_up(self.watermark.value, self.clock_ref[0], 'restart')
+        self.schedule_jobs()
+        self.timer.add('clock', time.time() + CLOCK_CHECK, self.clock_tick)
+        self.watcher.start()
+        self.discovery.start()
+        self.monitor.start()
+
+        # Sleep until the next job is due, jobs updates wake the timer up
+        self.timer.run()
+
+    def stop(self):
+        # Makes run() return
+        self.timer.stop()
+
+    def close(self):
+        # Save the pending changes and finish the pending sends
+        self.monitor.stop()
+        self.discovery.stop()
+        self.data.compact_if_needed()
+        self.jobs.compact_if_needed()
+        self.save_watermark()
+        self.devices.stop()
+
+    def get_solar(self):
         for itm in self.json_data:
             if itm['type'] == "location":
                 itm = itm['settings']
-                lat = itm['lat']
-                long = itm['long']
-                time_zone = itm['timezone']
-
-                tzinfo=pytz.timezone(time_zone)
-                city = LocationInfo(name="", region="", timezone=time_zone,
-                                latitude=lat, longitude=long)
-                date = datetime.date.today()
-                s = sun(city.observer, date=date, tzinfo=tzinfo)
-                return s
-
-        print ("Setup sun not found", flush=True)
+                # Sun times are cached next to the data file
+                cache_dir = os.path.join(os.path.dirname(os.path.abspath(self.data.path)), '.solar')
+                return SolarTable(itm['lat'], itm['long'], itm['timezone'], cache_dir)
+
+        log.warning("Setup sun not found")
         return None
 
     def get_signal(self, action):
-        for itm in self.json_data:
-            if itm['type'] == 'command' and itm['name'] == action:
-                data = bytearray.fromhex(''.join(itm['data'])) 
-                return data
+        data = self.commands.get(action)
+        if data is not None:
+            return data
 
-        print (f"Data not found for '{action}'", flush=True)
+        log.error("Data not found for '%s'", action, extra={'command': action})
         return None
 
-    def get_time(self, job_time):
-        once = False
-        if job_time.startswith("sunset"):
-            job_time = self.suntime['dusk'] + datetime.timedelta(minutes=self.extract_time_offset(job_time))
-            job_time = job_time.strftime('%H:%M')
-            once = True 
-        elif job_time.startswith("sunrise"):
-            job_time = self.suntime['dawn'] + datetime.timedelta(minutes=self.extract_time_offset(job_time))
-            job_time = job_time.strftime('%H:%M')
-            once = True 
-        return job_time, once
-
-    def send_single (self, action):
-        if (not action):
-            print("Nothing to do", flush=True)
-            return
+    def get_time(self, job_time, after, recurrence=EVERY_DAY):
+        # Next run of 'HH:MM', 'sunset[+-offset]' or 'sunrise[+-offset]' after 'after',
+        # only the days of the recurrence are tried
+        event, at = parse_time(job_time)
+        if event is not None:
+            time_on = functools.partial(self.sun_time, event, at)
+        else:
+            time_on = lambda date: datetime.datetime.combine(date, at)
 
-        data = self.get_signal(action)
-        print (f"Send {action}", flush=True)
-        if data != None:
-            self.device.send_data(data)
+        # From the day before: a sun offset can move a run past midnight
+        for date in recurrence.dates(after.date() - datetime.timedelta(days=1)):
+            when = time_on(date)
+            if when is not None and when > after:
+                return when
+        return None
 
-    def send_rfdata(self, job):
+    def sun_time(self, event, offset, date):
+        # Exact time of the event on that day, computed every day so the job
+        # follows the sun and DST changes. None if the sun does not reach it.
+        if self.solar is None:
+            return None
+        sun_time = self.solar.get(date, event)
+        if sun_time is None:
+            return None
+        # Local time of the system, as the other jobs
+        return (sun_time + datetime.timedelta(minutes=offset)).astimezone().replace(tzinfo=None)
+
+    def get_sends(self, actions, burst=False, gap=BURST_GAP):
+        # (name, device, data) of each transmission for a list of actions
+        sends = []
+        for action in actions:
+            if (not action):
+                continue
+            data = self.get_signal(action)
+            if data != None:
+                sends.append((action, self.commands.device(action), data))
+        if not burst:
+            return sends
+
+        # Merge the consecutive actions sent by the same device into bursts
+        merged = []
+        for device_name, group in itertools.groupby(sends, key=lambda send: send[1]):
+            device = self.devices.get(device_name)
+            max_payload = device.settings.get('max_payload', MAX_PAYLOAD) if device else MAX_PAYLOAD
+            signals = [(name, data) for name, _, data in group]
+            for names, data in compose_burst(signals, gap, max_payload):
+                merged.append(('+'.join(names), device_name, data))
+        return merged
+
+    def send_single(self, action, device_name, data, due):
+        # Queued to the device worker, the timer thread never blocks on a send
+        self.devices.send(device_name, action, data, due)
+
+    def send_rfdata(self, job, start):
+        job_id = job['id']
         job_name = job['name']
-        job_time = job['time']
-        job_param = job.get('parameters', None)
-        print(f"Running '{job_name}' with parameters: {job_param}", flush=True)
-        action1 = job_param['action1']
-        action2 = job_param['action2']
-        delay = job_param['delay']
-        weekday = job_param['weekday']
-        weekend = job_param['weekend']
-
-        # Execute depending of the day
-        week = datetime.datetime.today().isoweekday()
-        if (weekday and week <= 5) or (weekend and week > 5):
+        log.info("Running '%s' with parameters: %s", job_name, job.get('parameters'), extra={'event': 'job_fired', 'job': job_name})
+
+        # Jobs are only scheduled on their days (see recurrence.py).
+        # Each send is a timer entry at its offset from the job start,
+        # so the pauses of a job never delay another job
+        for i, (offset, *send) in enumerate(self.job_timeline(job)):
+            due = start + offset
+            self.timer.add(('step', job_id, start, i), due, self.send_single, *send, due)
+
+    def job_timeline(self, job):
+        # (offset, command, device, data) of the sends of a job, compiled
+        # once per version of the job and of data.json
+        cached = self.timelines.get(job['id'])
+        if cached is not None and cached[0] == job:
+            return cached[1]
+
+        job_param = job['parameters']
+        if job_param.get('scene'):
+            timeline = self.scenes.timeline(job_param['scene'])
+        else:
+            burst = job_param.get('burst', False)
+            gap = job_param.get('burst_gap', BURST_GAP)
+            offset = 0
+            timeline = []
             # action 1
-            for action in action1:
-                self.send_single(action)
-                time.sleep(0.5)
+            for send in self.get_sends(job_param['action1'], burst, gap):
+                timeline.append((offset, *send))
+                offset += STEP_GAP
             # pause
-            print(f"Pause {delay}s", flush=True)
-            time.sleep(delay)
+            offset += job_param['delay']
             # action 2
-            for action in action2:
-                self.send_single(action)
-                time.sleep(0.5)
-
-    def learn_rfdata(self, device, frequency):
-        print(f"Entering learning mode. Please send the RF signal now...", flush=True)
-        device.find_rf_packet(frequency)
-        time.sleep(5)  # Wait for the signal to be received
-        data = device.check_data()
-        if data is not None:
-            print(f"RF signal learned: {data}", flush=True)
-            return data
-        else:
-            print("No RF signal received.", flush=True)
-            return None
-
-    def read_data_from_json(self, json_file):
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-        return data
-
-    def extract_time_offset(self, job_time):
-        # Extract the numeric value at the end of the string
-        match = re.search(r'([-+]?\d+)$', job_time)
-        if match:
-            time_offset = int(match.group(1))
-            if job_time[-1] == '-':
-                time_offset *= -1
-            return time_offset
-        else:
-            return 0
+            for send in self.get_sends(job_param['action2'], burst, gap):
+                timeline.append((offset, *send))
+                offset += STEP_GAP
+            timeline = tuple(timeline)
+        self.timelines[job['id']] = (job, timeline)
+        return timeline
 
     def schedule_jobs(self):
         for job in self.json_jobs:
-            # Schedule the job with the specified time and parameters
-            job_name = job['name']
-            job_time = job['time']
-            enabled = job.get('enabled', True)
-            if not enabled:
-                print(f"Job '{job_name}' is disabled, skipping scheduling.", flush=True)
-                continue
-            job_param = job.get('parameters', None)
+            self.schedule_job(job)
 
-            job_time, once = self.get_time(job_time)
+        self.timer.add('compact', time.time() + COMPACT_INTERVAL, self.compact)
 
-            print(f"Schedule job '{job_name}' at {job_time}: '{job_param}'", flush=True)
-            schedule.every().day.at(job_time).do(self.send_rfdata, job)
+    def compact(self):
+        # Write the logged changes back to the JSON files
+        self.data.compact_if_needed()
+        self.jobs.compact_if_needed()
+        self.timer.add('compact', time.time() + COMPACT_INTERVAL, self.compact)
 
-        # Restart scheduler every morning to update the sunrise/sunset times
-        schedule.every().day.at("04:00").do(self.reschedule)
+    def schedule_job(self, job, after=None):
+        # Schedule the job with the specified time and parameters
+        job_id = job['id']
+        job_name = job['name']
+        enabled = job.get('enabled', True)
+        if not enabled:
+            log.info("Job '%s' is disabled, skipping scheduling.", job_name)
+            self.unschedule(job_id)
+            return
+        job_param = job.get('parameters', None)
+
+        # Report unknown commands now rather than when the job fires
+        unknown = self.commands.unknown(list(job_param.get('action1', [])) + list(job_param.get('action2', [])))
+        if unknown:
+            log.warning("Job '%s' uses unknown commands: %s", job_name, unknown, extra={'job': job_name})
+        try:
+            self.job_timeline(job)
+        except SceneError as e:
+            log.warning("Job '%s' has an invalid scene: %s", job_name, e, extra={'job': job_name})
+            self.unschedule(job_id)
+            return
+
+        if after is None:
+            # A run due but not started yet (busy timer) is not lost
+            due = self.timer.due(('job', job_id))
+            now = time.time()
+            after = datetime.datetime.fromtimestamp(min(now, due - 1) if due is not None else now)
+        try:
+            recurrence = Recurrence.from_parameters(job_param)
+            catch_up_policy(job_param)
+            when = self.get_time(job.get('time'), after, recurrence)
+        except (TypeError, ValueError) as e:
+            # Logged and left unscheduled, the other jobs still run
+            log.warning("Job '%s' is invalid: %s", job_name, e, extra={'job': job_name})
+            self.unschedule(job_id)
+            return
+
+        if when is None:
+            log.warning("Job '%s' has no next run", job_name, extra={'job': job_name})
+            self.unschedule(job_id)
+            return
+
+        log.info("Schedule job '%s' at %s: '%s'", job_name, when, job_param,
+                 extra={'event': 'job_scheduled', 'job': job_name, 'due': when.timestamp()})
+        self.timer.add(('job', job_id), when.timestamp(), self.run_job, job, when)
+        self.jobs.set_next(job_id, when.timestamp())
+
+    def unschedule(self, job_id):
+        self.timer.cancel(('job', job_id))
+        self.jobs.set_next(job_id, None)
+
+    def run_job(self, job, when):
+        if self.check_clock():
+            # All the jobs were rescheduled, their missed runs handled
+            return
+        now = time.time()
+        start = when.timestamp()
+        JOB_OFFSET.observe(now - start, job=job['name'])
+        if now - start > MISSED_AFTER:
+            # Blocked or suspended: handled as a missed run
+            policy, grace = catch_up_policy(job['parameters'])
+            run = self.missed(job, policy, catch_up_run(policy, grace, [start], now), [start], 'late_fire')
+            if run is not None:
+                JOB_RUNS.inc(job=job['name'])
+                self.send_rfdata(job, now)
+        else:
+            JOB_RUNS.inc(job=job['name'])
+            self.send_rfdata(job, start)
+        self.watermark.advance(start)
+
+        # Schedule the next run of the current version of the job, under the
+        # store lock so a concurrent change or removal is not undone
+        with self.jobs.lock:
+            job = self.jobs.get(job['id'])
+            if job is not None:
+                self.schedule_job(job, after=max(when, datetime.datetime.now()))
+
+    def missed(self, job, policy, run, missed, reason):
+        # Report the missed runs of a job, returns 'run'
+        log.warning("Job '%s' missed %s runs (%s), policy %s: %s", job['name'], len(missed), reason, policy,
+                    'run now' if run is not None else 'skipped',
+                    extra={'event': 'job_missed', 'job': job['name'], 'missed': missed,
+                           'policy': policy, 'run': run, 'reason': reason})
+        JOB_CATCH_UPS.inc(job=job['name'], policy=policy, result='ran' if run is not None else 'skipped')
+        return run
+
+    def missed_runs(self, job, recurrence, start, end):
+        # Timestamps of the runs of a job in (start, end]
+        runs = []
+        after = datetime.datetime.fromtimestamp(start)
+        while True:
+            when = self.get_time(job['time'], after, recurrence)
+            if when is None or when.timestamp() > end:
+                return runs
+            runs.append(when.timestamp())
+            after = when
+
+    def catch_up(self, start, end, reason):
+        # Apply the catch-up policy of each job to its runs missed in (start, end],
+        # the runs kept start now in the order they were due
+        start = max(start, end - MAX_CATCH_UP)
+        runs = []
+        for job in self.json_jobs:
+            if not job.get('enabled', True):
+                continue
+            try:
+                policy, grace = catch_up_policy(job['parameters'])
+                missed = self.missed_runs(job, Recurrence.from_parameters(job['parameters']), start, end)
+                if missed:
+                    # Compiled now, a job that can not be sent is skipped
+                    self.job_timeline(job)
+            except SceneError as e:
+                log.warning("Job '%s' has an invalid scene: %s", job['name'], e, extra={'job': job['name']})
+                continue
+            except (TypeError, ValueError):
+                # Reported when scheduled
+                continue
+            if missed:
+                run = self.missed(job, policy, catch_up_run(policy, grace, missed, end), missed, reason)
+                if run is not None:
+                    runs.append((run, job))
+
+        for run, job in sorted(runs, key=lambda run: run[0]):
+            JOB_RUNS.inc(job=job['name'])
+            self.send_rfdata(job, time.time())
+        self.watermark.advance(end)
+
+    def check_clock(self):
+        # Compare the wall clock with the monotonic clock since the last check.
+        # On a forward jump the runs of the skipped time are missed runs and
+        # the jobs are rescheduled from the new time, returns True.
+        wall, mono = time.time(), time.monotonic()
+        if self.clock_ref is None:
+            self.clock_ref = (wall, mono)
+            return False
+        last_wall, last_mono = self.clock_ref
+        self.clock_ref = (wall, mono)
+        expected = last_wall + mono - last_mono
+        jump = wall - expected
+        if abs(jump) < CLOCK_JUMP:
+            return False
+
+        log.warning("Wall clock jumped by %.0fs", jump, extra={'event': 'clock_jump', 'jump': jump})
+        CLOCK_JUMPS.inc(direction='forward' if jump > 0 else 'backward')
+        if jump < 0:
+            # Timer entries keep their wall time, runs done are not repeated
+            return False
+        with self.jobs.lock:
+            # Runs before the watermark were done (clock set back at boot then fixed)
+            self.catch_up(max(expected, self.watermark.value or expected), wall, 'clock_jump')
+            now = datetime.datetime.now()
+            for job in self.json_jobs:
+                self.schedule_job(job, after=now)
+        return True
+
+    def clock_tick(self):
+        self.check_clock()
+        self.save_watermark()
+        self.timer.add('clock', time.time() + CLOCK_CHECK, self.clock_tick)
+
+    def save_watermark(self):
+        # Every run before the first pending one was processed
+        now = time.time()
+        first = self.jobs.first_fire()
+        self.watermark.advance(min(now, first - 0.001) if first is not None else now)
 
     def reschedule(self):
-        print("Rescheduling jobs...", flush=True)
-        self.suntime = self.get_sun()
-        self.scheduler_reset.set()
-
-    def update_jobs(self):
-        print("update jobs -> restart scheduler thread", flush=True)
-        self.scheduler_reset.set()
-
-    def update_device(self):
-        print("update broadlink device", flush=True)
-        self.json_data = self.read_data_from_json(self.data_file)
-        del self.device
-        if self.setup_device():
-            print("Device updated", flush=True)
-            return self.device
-        return None
+        log.info("Rescheduling sunrise/sunset jobs...")
+        self.solar = self.get_solar()
+        for job in self.json_jobs:
+            if job['time'].startswith(("sunset", "sunrise")):
+                self.schedule_job(job)
+
+    def update_jobs(self, changes):
+        # Changes from the web server or from jobs.json edits,
+        # only the timer entries of the jobs that changed are touched
+        if not changes:
+            return
+        log.info("update jobs -> %s jobs changed", len(changes))
+        self.json_jobs = self.jobs.items()
+        for job_id, old, job in changes:
+            if job is None:
+                log.info("Job '%s' removed", old['name'])
+                self.unschedule(job_id)
+            else:
+                self.schedule_job(job)
+
+    def update_data(self, changes):
+        # Changes from the web server or from data.json edits
+        if not changes:
+            return
+        log.info("update data -> %s entries changed", len(changes))
+        self.json_data = self.data.items()
+        devices = False
+        location = False
+        commands = False
+        scenes = False
+        for key, old, new in changes:
+            entry_type = (new or old).get('type')
+            if entry_type == 'command':
+                commands = True
+                if new is None:
+                    self.commands.remove(old['name'])
+                    continue
+                try:
+                    self.commands.update(new['name'], new['data'], new.get('device'))
+                except ValueError as e:
+                    log.warning("Invalid data for '%s': %s", new['name'], e, extra={'command': new['name']})
+            elif entry_type == 'scene':
+                scenes = True
+            elif entry_type == 'device':
+                devices = True
+            elif entry_type == 'location':
+                location = True
+
+        if devices:
+            # Only the devices whose settings changed are reconnected
+            changed = self.devices.load(self.json_data)
+            log.info("Devices updated: %s", changed)
+        if commands or devices or scenes:
+            # Timelines hold the data of the commands and their device
+            self.scenes.load(self.json_data)
+            self.timelines = {}
+        if scenes:
+            # Jobs of a scene which was fixed or broken
+            for job in self.json_jobs:
+                if job['parameters'].get('scene'):
+                    self.schedule_job(job)
+        if location:
+            self.reschedule()
+
+    def device_moved(self, name, host):
+        # A down device was found at another address, save it in data.json
+        def update(data):
+            for i, entry in enumerate(data):
+                if entry.get('type') == 'device' and DeviceRegistry.device_name(entry) == name:
+                    data[i] = dict(entry, settings=dict(entry['settings'], host=host))
+
+        with self.data.lock:
+            self.update_data(self.data.modify(update))
+
+    def file_changed(self, path):
+        # data.json or jobs.json modified outside of the web server
+        start = time.perf_counter()
+        if path == os.path.abspath(self.jobs.path):
+            with self.jobs.lock:
+                self.update_jobs(self.jobs.reload())
+        elif path == os.path.abspath(self.data.path):
+            with self.data.lock:
+                self.update_data(self.data.reload())
+        else:
+            return
+        RELOAD_SECONDS.observe(time.perf_counter() - start, file=os.path.basename(path))
 
 def main(argv=None):
     parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
     parser.add_argument("-d", "--data", default='data.json', help="configuration file (signals)")
     parser.add_argument("-j", "--jobs", default='jobs.json', help="jobs list file")
-    args = parser.parse_args()
-
-    scheduler = Scheduler(args.data, args.jobs)
-
-    # Start web server with initialized device
-    web_server = web(args.data, args.jobs, scheduler.device, scheduler.update_jobs, scheduler.update_device)
-    web_server.start()
+    parser.add_argument("-l", "--library", help="binary command library (see library.py), without extension")
+    parser.add_argument("-s", "--server", choices=SERVERS, default='pool', help="web server backend")
+    parser.add_argument("-t", "--threads", type=int, default=8, help="web server worker threads")
+    parser.add_argument("--health-interval", type=int, default=HEALTH_INTERVAL,
+                        help="interval between the device health checks (s), 0 to disable")
+    parser.add_argument("--log-level", default='INFO', help="default log level")
+    parser.add_argument("--log-levels", type=parse_levels, default=[],
+                        help="levels per component, e.g. devices=DEBUG,web=WARNING")
+    parser.add_argument("--log-format", choices=FORMATS, default='json', help="log lines format")
+    parser.add_argument("--log-file", help="also log to this file, rotated every 10MB")
+    args = parser.parse_args(argv)
+
+    logs = setup_logs(args.log_level, args.log_levels, args.log_format, args.log_file)
+
+    data = JsonStore(args.data, data_key)
+    jobs = JobRepository(args.jobs)
+    library = CommandLibrary(args.library) if args.library else None
+    scheduler = Scheduler(data, jobs, library, args.health_interval)
+
+    # Start web server sharing the scheduler devices and configuration
+    web_server = web(data, jobs, scheduler.devices, scheduler.commands,
+                     scheduler.update_jobs, scheduler.update_data, scheduler.discovery)
+    web_server.start(args.server, args.threads)
+
+    # Stop on SIGTERM/SIGINT: no more requests, then save and finish the sends
+    def stop(signum, frame):
+        log.info("Stopping (%s)", signal.Signals(signum).name)
+        scheduler.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
     scheduler.run()
+    web_server.stop()
+    scheduler.close()
+    logs.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,76 @@
+import datetime, json, logging, os
+import pytz
+
+from astral import LocationInfo
+from astral.sun import dawn, sunrise, sunset, dusk
+
+log = logging.getLogger('solar')
+
+EVENTS = {'dawn': dawn, 'sunrise': sunrise, 'sunset': sunset, 'dusk': dusk}
+
+
+class SolarTable:
+    """Dawn, sunrise, sunset and dusk of every day of the year for a location.
+
+    A year is computed in one pass when first needed and cached on disk,
+    keyed by latitude, longitude, timezone and year. Times are stored as
+    UTC timestamps, indexed by the day of the year in the location timezone.
+    """
+
+    def __init__(self, lat, long, timezone, cache_dir=None):
+        self.lat = lat
+        self.long = long
+        self.timezone = timezone
+        self.tzinfo = pytz.timezone(timezone)
+        self.cache_dir = cache_dir
+        self.years = {}
+
+    def cache_path(self, year):
+        if self.cache_dir is None:
+            return None
+        name = f"{self.lat}_{self.long}_{self.timezone.replace('/', '-')}_{year}.json"
+        return os.path.join(self.cache_dir, name)
+
+    def compute(self, year):
+        observer = LocationInfo(name="", region="", timezone=self.timezone,
+                                latitude=self.lat, longitude=self.long).observer
+        table = {event: [] for event in EVENTS}
+        date = datetime.date(year, 1, 1)
+        while date.year == year:
+            for event, func in EVENTS.items():
+                try:
+                    table[event].append(func(observer, date=date, tzinfo=self.tzinfo).timestamp())
+                except ValueError:
+                    # The sun does not reach this elevation on that day (polar day/night)
+                    table[event].append(None)
+            date += datetime.timedelta(days=1)
+        return table
+
+    def load(self, year):
+        path = self.cache_path(year)
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+
+        log.info("Computing sun times of %s", year)
+        table = self.compute(year)
+        if path is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(table, f)
+            os.replace(tmp_path, path)
+        return table
+
+    def get(self, date, event):
+        # Time of the event on the given local date, None if it does not happen
+        table = self.years.get(date.year)
+        if table is None:
+            table = self.years[date.year] = self.load(date.year)
+        timestamp = table[event][date.timetuple().tm_yday - 1]
+        if timestamp is None:
+            return None
+        return datetime.datetime.fromtimestamp(timestamp, self.tzinfo)
@@ -0,0 +1,231 @@
+import json, logging, os
+import threading
+
+log = logging.getLogger('storage')
+
+
+def job_key(entry):
+    # Jobs are identified by id, by name in files written before the ids
+    return entry.get('id') or entry['name']
+
+
+def data_key(entry):
+    # Commands are identified by name, devices by name or MAC address (as
+    # DeviceRegistry.device_name), location is unique
+    if entry.get('type') == 'device' and not entry.get('name'):
+        return f"device:{entry.get('settings', {}).get('mac') or ''}"
+    return f"{entry.get('type')}:{entry.get('name') or ''}"
+
+
+def copy_entry(value):
+    # Deep copy of JSON data
+    if isinstance(value, dict):
+        return {key: copy_entry(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_entry(item) for item in value]
+    return value
+
+
+class EntryList(list):
+    """Entries given to the function of JsonStore.modify.
+
+    The entries of the model are shared with the readers, each one is
+    copied the first time it is read from the list so it can be modified
+    in place. The entries never read stay the ones of the model.
+    """
+
+    def __init__(self, entries):
+        super().__init__(entries)
+        self.shared = {id(entry) for entry in entries}
+
+    def copied(self, index):
+        entry = list.__getitem__(self, index)
+        if id(entry) in self.shared:
+            entry = copy_entry(entry)
+            list.__setitem__(self, index, entry)
+        return entry
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.copied(i) for i in range(*index.indices(len(self)))]
+        return self.copied(index)
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self.copied(i)
+            i += 1
+
+    def __reversed__(self):
+        for i in range(len(self) - 1, -1, -1):
+            yield self.copied(i)
+
+    def pop(self, index=-1):
+        self.copied(index)
+        return list.pop(self, index)
+
+    def copy(self):
+        return list(self)
+
+    def values(self):
+        # The entries, without copying them
+        return list(list.__iter__(self))
+
+
+class JsonStore:
+    """In-memory model of a JSON list file (jobs.json, data.json).
+
+    The model is the reference, readers get an immutable snapshot without
+    touching the disk. Changes are appended to a write-ahead log
+    ('<file>.wal') and the file itself is rewritten atomically (temporary
+    file + rename) when the log is compacted.
+    """
+
+    def __init__(self, path, key, compact_every=100):
+        self.path = path
+        self.wal_path = path + '.wal'
+        self.key = key
+        self.compact_every = compact_every
+        self.lock = threading.RLock()
+        self.entries = ()
+        self.stat = None
+        self.version = 0
+        self.pending = 0
+        self.load()
+
+    def load(self):
+        with self.lock:
+            entries, replayed = self.read()
+            self.set_entries(entries)
+            if replayed:
+                self.compact()
+
+    def read(self):
+        # Returns the entries and the number of changes the file does not have yet
+        stat = os.stat(self.path)
+        with open(self.path, 'r') as f:
+            entries = json.load(f)
+        self.stat = (stat.st_mtime_ns, stat.st_size)
+
+        # Replay the changes not compacted yet
+        replayed = 0
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, 'r') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        # Partial last line of a crash during append
+                        break
+                    self.apply(entries, op)
+                    replayed += 1
+        if replayed:
+            log.info("Replayed %s changes of %s", replayed, self.wal_path)
+        return entries, replayed
+
+    def reload(self):
+        # Reload the file if it was modified by someone else, returns the
+        # list of (key, old, new) changes compared to the current model
+        with self.lock:
+            stat = os.stat(self.path)
+            if (stat.st_mtime_ns, stat.st_size) == self.stat:
+                return []
+            entries, replayed = self.read()
+            changes = self.diff(self.entries, entries)
+            self.set_entries(entries)
+            if replayed:
+                self.compact()
+            return changes
+
+    def set_entries(self, entries):
+        # New version of the model, subclasses update their indexes here
+        self.entries = tuple(entries)
+        self.version += 1
+
+    def diff(self, old_entries, new_entries):
+        old = {self.key(entry): entry for entry in old_entries}
+        new = {self.key(entry): entry for entry in new_entries}
+        changes = []
+        for key, entry in old.items():
+            if key not in new:
+                changes.append((key, entry, None))
+        for key, entry in new.items():
+            if old.get(key) != entry:
+                changes.append((key, old.get(key), entry))
+        return changes
+
+    def apply(self, entries, op):
+        index = next((i for i, entry in enumerate(entries) if self.key(entry) == op['key']), None)
+        if op['op'] == 'put':
+            if index is None:
+                # New entries keep their position (the first device is the default one)
+                entries.insert(op.get('index', len(entries)), op['entry'])
+            else:
+                entries[index] = op['entry']
+        elif op['op'] == 'remove' and index is not None:
+            del entries[index]
+
+    def items(self):
+        return self.entries
+
+    def get(self, key):
+        return next((entry for entry in self.entries if self.key(entry) == key), None)
+
+    def modify(self, func):
+        # Run func on an EntryList of the entries and log what it changed.
+        # Only the entries func read (copies) or added are compared with the
+        # model. The whole read-modify-write is done under the lock so
+        # concurrent changes are never lost. Returns the list of (key, old, new).
+        with self.lock:
+            entries = EntryList(self.entries)
+            func(entries)
+            entries = entries.values()
+            self.check(entries)
+
+            # Position of the entries read or added
+            old_ids = {id(entry) for entry in self.entries}
+            added = {id(entry): i for i, entry in enumerate(entries) if id(entry) not in old_ids}
+            new_ids = {id(entry) for entry in entries}
+            changes = self.diff([entry for entry in self.entries if id(entry) not in new_ids],
+                                [entries[i] for i in added.values()])
+            if changes:
+                self.log([{'op': 'put', 'key': key, 'entry': entry, 'index': added[id(entry)]}
+                          if entry is not None else {'op': 'remove', 'key': key}
+                          for key, _, entry in changes])
+                self.set_entries(entries)
+                if self.pending >= self.compact_every:
+                    self.compact()
+            return changes
+
+    def check(self, entries):
+        # Validate or complete the entries changed by modify, subclasses
+        # raise ValueError to reject the change
+        pass
+
+    def log(self, ops):
+        with open(self.wal_path, 'a') as f:
+            for op in ops:
+                f.write(json.dumps(op) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending += len(ops)
+
+    def compact(self):
+        # Write a snapshot of the model and drop the log
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self.entries), f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # Our own writes are not reloaded
+            stat = os.stat(self.path)
+            self.stat = (stat.st_mtime_ns, stat.st_size)
+            if os.path.exists(self.wal_path):
+                os.remove(self.wal_path)
+            self.pending = 0
+
+    def compact_if_needed(self):
+        if self.pending:
+            self.compact()
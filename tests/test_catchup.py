@@ -0,0 +1,31 @@
+"""Runs missed while the scheduler was down."""
+import json, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from jobs import JobRepository
+from scheduler import Scheduler
+from storage import JsonStore, data_key
+
+
+def make_scheduler(tmp_path, jobs):
+    data = [{'type': 'command', 'name': 'up', 'data': 'b20004000a141e28'},
+            {'type': 'scene', 'name': 'morning', 'steps': [{'command': 'up'}]}]
+    (tmp_path / 'data.json').write_text(json.dumps(data))
+    (tmp_path / 'jobs.json').write_text(json.dumps(jobs))
+    return Scheduler(JsonStore(str(tmp_path / 'data.json'), data_key), JobRepository(str(tmp_path / 'jobs.json')))
+
+
+def job(name, scene):
+    return {'name': name, 'time': '12:00', 'enabled': True,
+            'parameters': {'scene': scene, 'catch_up': 'coalesce'}}
+
+
+def test_invalid_scene_is_skipped(tmp_path):
+    # A job with an unknown scene does not stop the catch-up of the others
+    scheduler = make_scheduler(tmp_path, [job('broken', 'nowhere'), job('valid', 'morning')])
+    end = time.time()
+    scheduler.catch_up(end - 3 * 24 * 3600, end, 'restart')
+    valid = scheduler.jobs.find('valid')['id']
+    steps = [key for key in scheduler.timer.keys() if key[0] == 'step']
+    assert {key[1] for key in steps} == {valid}
+    assert scheduler.watermark.value == end
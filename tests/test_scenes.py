@@ -0,0 +1,107 @@
+"""Scene timelines walked by the timer with a fake clock."""
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from commands import CommandStore
+from scenes import SceneBook, SceneError, STEP_GAP
+from timer import Timer
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_book(scenes):
+    commands = CommandStore()
+    data = [{'type': 'command', 'name': name, 'data': bytes([0xb2, 0, 2, 0, i, i]).hex(), 'device': 'rm4'}
+            for i, name in enumerate(('up', 'down', 'stop', 'light'))]
+    commands.load(data)
+    book = SceneBook(commands)
+    book.load(data + [dict(scene, type='scene') for scene in scenes])
+    return book
+
+
+def play(book, name, start=1000.0, step=0.05, duration=10):
+    # Each send is a timer entry at its offset from the start, as the scheduler does,
+    # the fake clock is advanced in small steps and the send times recorded
+    clock = FakeClock(start)
+    timer = Timer(clock=clock)
+    sent = []
+    for i, (offset, command, device, data) in enumerate(book.timeline(name)):
+        timer.add(('step', name, i), start + offset, lambda command: sent.append((clock.now - start, command)), command)
+    for _ in range(int(duration / step) + 1):
+        timer.run_pending()
+        clock.now = round(clock.now + step, 6)
+    return [(round(offset, 2), command) for offset, command in sent]
+
+
+def test_gap_and_explicit_offsets():
+    book = make_book([{'name': 'morning', 'steps': [
+        {'command': 'up'},
+        {'command': 'down'},
+        {'command': 'stop', 'offset': 3},
+        {'command': 'light'}
+    ]}])
+    assert play(book, 'morning') == [(0, 'up'), (STEP_GAP, 'down'), (3, 'stop'), (3 + STEP_GAP, 'light')]
+
+
+def test_nested_scenes():
+    book = make_book([
+        {'name': 'inner', 'steps': [{'command': 'stop'}, {'command': 'light', 'offset': 1}]},
+        {'name': 'outer', 'gap': 0.25, 'steps': [
+            {'command': 'up'},
+            {'scene': 'inner', 'offset': 2},
+            # After the last step of the nested scene
+            {'command': 'down'},
+            # Listed last but sent second
+            {'command': 'up', 'offset': 0.1}
+        ]}
+    ])
+    assert play(book, 'outer') == [(0, 'up'), (0.1, 'up'), (2, 'stop'), (3, 'light'), (3.25, 'down')]
+    # The timeline carries the device and the payload
+    assert {device for _, _, device, _ in book.timeline('outer')} == {'rm4'}
+    assert book.timeline('outer')[0][3] == book.commands.get('up')
+
+
+def test_timer_waits_for_the_clock():
+    book = make_book([{'name': 'slow', 'steps': [{'command': 'up'}, {'command': 'down', 'offset': 5}]}])
+    clock = FakeClock()
+    timer = Timer(clock=clock)
+    sent = []
+    for offset, command, _, _ in book.timeline('slow'):
+        timer.add(command, clock.now + offset, sent.append, command)
+    timer.run_pending()
+    assert sent == ['up']
+    clock.now += 4.99
+    timer.run_pending()
+    assert sent == ['up']
+    clock.now += 0.01
+    timer.run_pending()
+    assert sent == ['up', 'down']
+
+
+def test_cycle():
+    book = make_book([
+        {'name': 'a', 'steps': [{'command': 'up'}, {'scene': 'b'}]},
+        {'name': 'b', 'steps': [{'scene': 'c'}]},
+        {'name': 'c', 'steps': [{'scene': 'a'}]}
+    ])
+    with pytest.raises(SceneError, match='cycle a -> b -> c -> a'):
+        book.timeline('a')
+
+
+def test_unknown_scene_and_invalid_offset():
+    book = make_book([
+        {'name': 'missing', 'steps': [{'scene': 'nowhere'}]},
+        {'name': 'negative', 'steps': [{'command': 'up', 'offset': -1}]}
+    ])
+    with pytest.raises(SceneError):
+        book.timeline('missing')
+    with pytest.raises(SceneError):
+        book.timeline('negative')
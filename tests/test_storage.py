@@ -0,0 +1,41 @@
+"""JsonStore changes, logged and replayed."""
+import json, os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from storage import JsonStore, data_key
+
+
+def device(name, host):
+    return {'type': 'device', 'name': name, 'settings': {'host': host, 'mac': name}}
+
+
+def make_store(tmp_path, entries):
+    path = tmp_path / 'data.json'
+    path.write_text(json.dumps(entries))
+    return JsonStore(str(path), data_key)
+
+
+def test_modified_in_place(tmp_path):
+    store = make_store(tmp_path, [device('hub', '10.0.0.1'), {'type': 'command', 'name': 'up', 'data': '00'}])
+    before = store.items()
+
+    def move(data):
+        for entry in data:
+            if entry['type'] == 'device':
+                entry['settings']['host'] = '10.0.0.2'
+
+    changes = store.modify(move)
+    assert [(key, new['settings']['host']) for key, _, new in changes] == [('device:hub', '10.0.0.2')]
+    # The snapshot of the readers did not change
+    assert before[0]['settings']['host'] == '10.0.0.1'
+    assert JsonStore(store.path, data_key).items() == store.items()
+
+
+def test_replay_keeps_positions(tmp_path):
+    # The first device is the default one, the log must not reorder them
+    store = make_store(tmp_path, [device('hub', '10.0.0.1')])
+    store.modify(lambda data: data.insert(0, device('main', '10.0.0.3')))
+    store.modify(lambda data: data.insert(1, device('garage', '10.0.0.4')))
+    assert os.path.exists(store.wal_path)
+    replayed = JsonStore(store.path, data_key)
+    assert [entry['name'] for entry in replayed.items()] == ['main', 'garage', 'hub']
@@ -0,0 +1,98 @@
+import heapq, itertools, logging
+import threading, time
+
+log = logging.getLogger('timer')
+
+
+class Timer:
+    """Calls functions at given wall-clock times.
+
+    Entries are kept in a heap ordered by due time and the run loop sleeps
+    until the earliest one is due, or until an entry is added/cancelled.
+    'clock' gives the current time, a fake clock can drive run_pending().
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.wakeups = 0
+
+    def add(self, key, when, func, *args):
+        # Add an entry, replacing any entry already registered with this key
+        with self.cond:
+            self._cancel(key)
+            entry = [when, next(self.counter), key, func, args]
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            # Only wake the loop up if the next due time changed
+            if self.heap[0] is entry:
+                self.cond.notify()
+
+    def cancel(self, key):
+        with self.cond:
+            self._cancel(key)
+
+    def _cancel(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            # Lazy removal, the entry is dropped when it reaches the top of the heap
+            entry[3] = None
+
+    def due(self, key):
+        with self.cond:
+            entry = self.entries.get(key)
+            return entry[0] if entry else None
+
+    def keys(self):
+        with self.cond:
+            return list(self.entries)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                entry = None
+                while entry is None:
+                    if self.stopped:
+                        return
+                    while self.heap and self.heap[0][3] is None:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                    else:
+                        delay = self.heap[0][0] - self.clock()
+                        if delay > 0:
+                            self.cond.wait(delay)
+                        else:
+                            entry = heapq.heappop(self.heap)
+                            del self.entries[entry[2]]
+                    self.wakeups += 1
+
+            self.call(entry)
+
+    def run_pending(self):
+        # Call the entries already due and return, without waiting
+        while True:
+            with self.cond:
+                while self.heap and self.heap[0][3] is None:
+                    heapq.heappop(self.heap)
+                if not self.heap or self.heap[0][0] > self.clock():
+                    return
+                entry = heapq.heappop(self.heap)
+                del self.entries[entry[2]]
+            self.call(entry)
+
+    def call(self, entry):
+        when, _, key, func, args = entry
+        try:
+            func(*args)
+        except Exception as e:
+            log.exception("Timer entry %s failed: %s", key, e)
@@ -0,0 +1,92 @@
+import ctypes, ctypes.util, logging
+import os, select, struct
+import threading, time
+
+# inotify events: file written and closed, file renamed over (atomic saves)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT_HEADER = struct.Struct('iIII')
+
+log = logging.getLogger('watcher')
+
+
+class FileWatcher:
+    """Calls callback(path) when one of the watched files changes.
+
+    Uses inotify on the parent directories when available (so files
+    replaced by a rename are seen too), otherwise polls the files mtime
+    and size every 'interval' seconds.
+    """
+
+    def __init__(self, paths, callback, interval=2, debounce=0.2):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.interval = interval
+        self.debounce = debounce
+        self.thread = None
+
+    def start(self):
+        fd = self.inotify_init()
+        if fd is not None:
+            self.thread = threading.Thread(target=self.inotify_loop, args=(fd,), daemon=True)
+        else:
+            log.warning("inotify not available, polling the configuration files")
+            self.thread = threading.Thread(target=self.poll_loop, daemon=True)
+        self.thread.start()
+
+    def inotify_init(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            for directory in {os.path.dirname(path) for path in self.paths}:
+                if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                    os.close(fd)
+                    return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def inotify_loop(self, fd):
+        names = {os.path.basename(path): path for path in self.paths}
+        while True:
+            changed = set()
+            timeout = None
+            # Group the events of a save (several writes, rename...) together
+            while select.select([fd], [], [], timeout)[0]:
+                buffer = os.read(fd, 4096)
+                offset = 0
+                while offset < len(buffer):
+                    _, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+                    offset += EVENT_HEADER.size
+                    name = buffer[offset:offset + length].rstrip(b'\0').decode()
+                    offset += length
+                    if name in names:
+                        changed.add(names[name])
+                timeout = self.debounce
+            for path in changed:
+                self.notify(path)
+
+    def poll_loop(self):
+        stats = {path: self.stat(path) for path in self.paths}
+        while True:
+            time.sleep(self.interval)
+            for path in self.paths:
+                stat = self.stat(path)
+                if stat != stats[path]:
+                    stats[path] = stat
+                    self.notify(path)
+
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def notify(self, path):
+        try:
+            self.callback(path)
+        except Exception as e:
+            log.exception("Failed to reload '%s': %s", path, e)
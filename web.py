@@ -1,69 +1,203 @@
-import socket
-from flask import Flask, request, jsonify, render_template, redirect, url_for
-import json, time
-import threading
-import broadlink
+import logging
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, make_response
+import datetime, threading, uuid
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer
+
+import metrics
+from catchup import DEFAULT_POLICY, POLICIES, catch_up_policy
+from discovery import DiscoveryService
+from jobs import DuplicateJobName
+from learning import LearnManager
+from recurrence import Recurrence, parse_time
+
+log = logging.getLogger('web')
+
+# Default and longest duration of a learning session (s)
+LEARN_TIMEOUT = 30
+# The discovery cache is refreshed when older than this (s)
+DISCOVERY_MAX_AGE = 30
+# Default window of the upcoming jobs (min)
+UPCOMING_MINUTES = 24 * 60
+# Web server backends: flask development server, werkzeug with a pool of
+# threads, waitress (optional dependency)
+SERVERS = ('flask', 'pool', 'waitress')
+
+
+def split_list(text):
+    return [item.strip() for item in text.split(',') if item.strip()]
+
+
+class PoolServer(BaseWSGIServer):
+    """Werkzeug server handling the requests on a fixed pool of threads"""
+
+    def __init__(self, host, port, app, threads):
+        super().__init__(host, port, app)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='web')
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        # Requests in progress are completed
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
 
 class web:
-    def __init__(self, data_file, jobs_file, device, job_update_cb, update_device_cb):
-        self.data_file = data_file
-        self.jobs_file = jobs_file
-        self.device = device
+    def __init__(self, data, jobs, devices, commands, job_update_cb, data_update_cb, discovery=None):
+        # JsonStore of data.json and JobRepository of jobs.json, shared with the scheduler
+        self.data = data
+        self.jobs = jobs
+        self.devices = devices
+        self.commands = commands
+        self.discovery = discovery or DiscoveryService(interval=0)
+        self.learning = LearnManager(self.save_learned)
+        # Rendered pages, by page name: (configuration version, ETag, html)
+        self.pages = {}
+        self.instance = uuid.uuid4().hex[:8]
         self.app = Flask(__name__)
+        self.server = None
+        self.thread = None
 
-        # Callback when a job is updated
+        # Callbacks with the list of changes when jobs or data are updated
         self.job_update_cb = job_update_cb
-        self.update_device_cb = update_device_cb
-
-        # Load the initial jobs from the JSON file
-        with open(self.jobs_file, 'r') as f:
-            self.jobs_data = json.load(f)
+        self.data_update_cb = data_update_cb
 
         # Setup routes
         self.app.route('/')(self.home)
         self.app.route('/add_job', methods=['POST'])(self.add_job)
         self.app.route('/remove_job', methods=['POST'])(self.remove_job)
         self.app.route('/settings')(self.settings)
+        self.app.route('/command_data/<path:name>')(self.command_data)
         self.app.route('/discover_devices', methods=['POST'])(self.discover_devices)
         self.app.route('/update_data', methods=['POST'])(self.update_data)
         self.app.route('/add_data', methods=['POST'])(self.add_data)
         self.app.route('/remove_data', methods=['POST'])(self.remove_data)
         self.app.route('/learn_command', methods=['POST'])(self.learn_command)
+        self.app.route('/learn_status/<session_id>')(self.learn_status)
+        self.app.route('/learn_cancel/<session_id>', methods=['POST'])(self.learn_cancel)
         self.app.route('/toggle_job', methods=['POST'])(self.toggle_job)
-
-    def save_jobs_to_json(self):
-        # Save the updated jobs to the JSON file
-        with open(self.jobs_file, 'w') as f:
-            json.dump(self.jobs_data, f, indent=4)
+        self.app.route('/upcoming')(self.upcoming)
+        self.app.route('/metrics')(self.get_metrics)
 
     def web_thread(self):
         self.app.run(host='::', port=8080)
         #self.app.run(host='0.0.0.0', port=8080)
 
-    def start(self):
-        thread = threading.Thread(target=self.web_thread)
-        thread.start()
+    def waitress_thread(self):
+        server = self.server
+        try:
+            server.run()
+        except OSError:
+            # stop() closes the sockets the loop may be waiting on
+            if self.server is server:
+                raise
+
+    def start(self, server='pool', threads=8, host='::', port=8080):
+        if server == 'waitress':
+            from waitress import create_server
+            self.server = create_server(self.app, host=host, port=port, threads=threads)
+            target = self.waitress_thread
+        elif server == 'pool':
+            self.server = PoolServer(host, port, self.app, threads)
+            target = self.server.serve_forever
+        else:
+            target = self.web_thread
+        log.info("Web server: %s", server)
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        # Stop accepting requests and let the ones in progress finish,
+        # the development server can not be stopped
+        if self.server is None:
+            return
+        if isinstance(self.server, PoolServer):
+            self.server.shutdown()
+            self.server.server_close()
+        else:
+            # The requests in progress finish while the server and its trigger,
+            # which wakes up the loop to send their responses, are still open.
+            # The queued ones are cancelled.
+            server = self.server
+            self.server = None
+            server.task_dispatcher.shutdown(timeout=timeout)
+            server.close()
+        self.thread.join(timeout)
+        self.server = None
+
+    def get_metrics(self):
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def change_jobs(self, func):
+        # Modify jobs.json and update the scheduler under the store lock,
+        # so the scheduler gets concurrent changes in the order they were made
+        with self.jobs.lock:
+            changes = self.jobs.modify(func)
+            if self.job_update_cb is not None:
+                self.job_update_cb(changes)
+        return changes
+
+    def change_data(self, func):
+        with self.data.lock:
+            changes = self.data.modify(func)
+            if self.data_update_cb is not None:
+                self.data_update_cb(changes)
+        return changes
+
+    def cached_page(self, page, render):
+        # Pages are rendered once per configuration version and revalidated
+        # by the browsers with their ETag
+        version = (self.data.version, self.jobs.version)
+        cached = self.pages.get(page)
+        if cached is None or cached[0] != version:
+            etag = f"{self.instance}-{page}-{version[0]}-{version[1]}"
+            cached = (version, etag, render())
+            self.pages[page] = cached
+
+        _, etag, html = cached
+        response = make_response(html)
+        response.set_etag(etag)
+        return response.make_conditional(request)
 
     def home(self):
-        # reload data from file
-        with open(self.jobs_file, 'r') as f:
-            jobs_data = json.load(f)
-
-        # Get available commands from data.json
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-            commands = [entry['name'] for entry in data if entry['type'] == 'command']
-    
-        # Render the home page with the list of jobs and commands
-        return render_template('index.html', jobs=jobs_data, commands=commands)
+        def render():
+            jobs_data = self.jobs.items()
+
+            # Get available command names, without loading their data
+            commands = self.commands.names()
+            scenes = [entry['name'] for entry in self.data.items() if entry.get('type') == 'scene']
+        
+            # Render the home page with the list of jobs, commands and scenes
+            return render_template('index.html', jobs=jobs_data, commands=commands, scenes=scenes,
+                                   policies=POLICIES, default_policy=DEFAULT_POLICY)
+
+        return self.cached_page('home', render)
+
+    def form_job_id(self):
+        # Jobs are posted by id, or by name
+        if request.form.get('id'):
+            return request.form['id']
+        job = self.jobs.find(request.form.get('name', ''))
+        return job['id'] if job is not None else None
 
     def add_job(self):
         try:
-            original_name = request.form.get('original_name')
+            job_id = request.form.get('id')
             new_name = request.form['name']
             
             delay = request.form.get('delay', '0')
             delay = int(delay) if delay else 0
+            burst_gap = request.form.get('burst_gap', '')
 
             job = {
                 "name": new_name,
@@ -73,149 +207,181 @@ class web:
                     "action1": request.form.getlist('action1'),
                     "delay": delay,
                     "action2": request.form.getlist('action2'),
-                    "weekday": 'weekday' in request.form,
-                    "weekend": 'weekend' in request.form
+                    "days": request.form.getlist('days'),
+                    "burst": 'burst' in request.form
                 }
             }
-
-            # If editing an existing job, update it in place
-            if original_name:
-                for i, existing_job in enumerate(self.jobs_data):
-                    if existing_job['name'] == original_name:
-                        self.jobs_data[i] = job
-                        break
-            else:
-                # Add new job at the end
-                self.jobs_data.append(job)
+            if burst_gap:
+                job['parameters']['burst_gap'] = int(burst_gap)
+            # Missed runs policy, see catchup.py
+            job['parameters']['catch_up'] = request.form.get('catch_up') or DEFAULT_POLICY
+            grace = request.form.get('grace', '')
+            if grace:
+                job['parameters']['grace'] = int(grace)
+            # A scene replaces the actions
+            if request.form.get('scene'):
+                job['parameters']['scene'] = request.form['scene']
+            # "06-01:09-30, 12-20:01-05" and "12-25, 2026-05-01"
+            periods = [period.split(':') for period in split_list(request.form.get('periods', ''))]
+            if periods:
+                job['parameters']['periods'] = periods
+            exclude = split_list(request.form.get('except', ''))
+            if exclude:
+                job['parameters']['except'] = exclude
+            # Rejected before saving, a job the scheduler can not run is never written
+            parse_time(job['time'])
+            if not job['parameters']['days']:
+                raise ValueError("no day selected")
+            Recurrence.from_parameters(job['parameters'])
+            catch_up_policy(job['parameters'])
+
+            def update(jobs_data):
+                # If editing an existing job, update it in place
+                if job_id:
+                    position = self.jobs.position(job_id)
+                    if position is not None:
+                        jobs_data[position] = dict(job, id=job_id)
+                else:
+                    # Add new job at the end, it gets an id when saved
+                    jobs_data.append(job)
         
-            # Save the updated jobs to the JSON file
-            self.save_jobs_to_json()
-
-            if self.job_update_cb is not None:
-                self.job_update_cb()
+            # Save the updated jobs
+            self.change_jobs(update)
 
             return redirect(url_for('home'))
+        except DuplicateJobName as e:
+            log.warning("A job named '%s' already exists", e)
+            return f"A job named '{e}' already exists", 409
+        except (TypeError, ValueError) as e:
+            log.warning("Invalid job: %s", e)
+            return f"Invalid job: {e}", 400
         except Exception as e:
-            print(f"Error adding/updating job: {e}", flush=True)
+            log.error("Error adding/updating job: %s", e)
             return redirect(url_for('home'))
 
     def remove_job(self):
-        # Parse the job name from the request
-        job_name = request.form['name']
+        # Parse the job id from the request
+        job_id = self.form_job_id()
 
-        # Remove the job from the jobs_data list
-        self.jobs_data[:] = [job for job in self.jobs_data if job['name'] != job_name]
+        def remove(jobs_data):
+            position = self.jobs.position(job_id)
+            if position is not None:
+                del jobs_data[position]
 
-        # Save the updated jobs to the JSON file
-        self.save_jobs_to_json()
-
-        if self.job_update_cb is not None:
-            self.job_update_cb()
+        # Remove the job and save the updated jobs
+        self.change_jobs(remove)
 
         # Redirect to the home page after removing the job
         return redirect(url_for('home'))
     
     def toggle_job(self):
-        job_name = request.form['name']
-        
-        # Find and update the job's enabled status
-        for job in self.jobs_data:
-            if job['name'] == job_name:
-                job['enabled'] = not job.get('enabled', True)
-                break
+        job_id = self.form_job_id()
         
-        self.save_jobs_to_json()
+        def toggle(jobs_data):
+            # Update the job's enabled status
+            position = self.jobs.position(job_id)
+            if position is not None:
+                job = jobs_data[position]
+                jobs_data[position] = dict(job, enabled=not job.get('enabled', True))
         
-        if self.job_update_cb is not None:
-            self.job_update_cb()
+        self.change_jobs(toggle)
     
         return redirect(url_for('home'))
 
+    def upcoming(self):
+        # Jobs firing in the next 'minutes', from the scheduler's index
+        minutes = request.args.get('minutes', UPCOMING_MINUTES, type=int)
+        return jsonify([{
+            'id': job['id'],
+            'name': job['name'],
+            'due': when,
+            'time': datetime.datetime.fromtimestamp(when).isoformat(timespec='seconds')
+        } for when, job in self.jobs.upcoming(minutes)])
+
     def settings(self):
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-        return render_template('settings.html', data=data)
+        def render():
+            # Commands are summarized, their data is loaded on demand by /command_data
+            commands = []
+            for name in self.commands.names():
+                summary = self.commands.summary(name)
+                device = self.devices.get(summary['device'])
+                summary['frequency'] = device.settings.get('frequency') if device else None
+                commands.append(summary)
+            data = [entry for entry in self.data.items() if entry['type'] != 'command']
+            return render_template('settings.html', data=data, commands=commands)
+
+        return self.cached_page('settings', render)
+
+    def command_data(self, name):
+        data = self.commands.get(name)
+        if data is None:
+            return jsonify({'success': False, 'message': f"Unknown command '{name}'"}), 404
+        response = jsonify({'success': True, 'name': name, 'data': data.hex()})
+        response.set_etag(f"{self.instance}-{name}-{self.data.version}")
+        return response.make_conditional(request)
     
     def discover_devices(self):
-        try:
-            print("Starting device discovery...", flush=True)
-            
-            # Try discovering on local subnet
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            local_ip = s.getsockname()[0]
-            s.close()
-            print(f"Local IP: {local_ip}", flush=True)
-            devices = broadlink.discover(timeout=5, local_ip_address=local_ip)
-            device_list = []
-            print(f"Found {len(devices)} devices", flush=True)
-            
-            for device in devices:
-                try:
-                    print(f"Found device: type={hex(device.devtype)}, host={device.host[0]}", flush=True)
-                    device_list.append({
-                        'devtype': hex(device.devtype),
-                        'host': device.host[0],
-                        'mac': ':'.join(format(x, '02x') for x in device.mac)
-                    })
-                except Exception as e:
-                    print(f"Error processing device: {e}", flush=True)
-        
-            # If no devices found, add the currently connected device
-            if len(device_list) == 0 and self.device is not None:
-                print("No new devices found, adding current device", flush=True)
+        # Answered from the discovery cache, a scan is started in the
+        # background when the cache is older than DISCOVERY_MAX_AGE
+        refreshing = self.discovery.refresh_async(DISCOVERY_MAX_AGE)
+        device_list = [{
+            'devtype': hex(device['devtype']),
+            'host': device['host'],
+            'mac': device['mac']
+        } for device in self.discovery.get()]
+
+        # If no devices found, add the configured devices
+        if len(device_list) == 0 and not refreshing:
+            log.info("No new devices found, adding configured devices")
+            for device in self.devices.devices.values():
                 device_list.append({
-                    'devtype': hex(self.device.devtype),
-                    'host': self.device.host[0],
-                    'mac': ':'.join(format(x, '02x') for x in self.device.mac)
+                    'devtype': device.settings['devtype'],
+                    'host': device.settings['host'],
+                    'mac': device.settings['mac']
                 })
-            
-            return jsonify({
-                'success': True,
-                'devices': device_list
-            })
-        except Exception as e:
-            print(f"Discovery error: {str(e)}", flush=True)
-            return jsonify({
-                'success': False,
-                'message': str(e)
-            })
+
+        return jsonify({
+            'success': True,
+            'devices': device_list,
+            'refreshing': refreshing
+        })
 
     def update_data(self):
         try:
             data_name = request.form.get('name', '')
             data_type = request.form.get('type', '')
+            original_mac = request.form.get('original_mac', '')
             
-            with open(self.data_file, 'r') as f:
-                data = json.load(f)
-            
-            # Update existing data entry
-            for entry in data:
-                if entry.get('type') == data_type:
-                    if data_type == 'command' and data_name == entry['name']:
-                        entry['data'] = request.form['data']
-                        break
-                    elif data_type == 'device':
-                        entry['settings'] = {
-                            'devtype': request.form['devtype'],
-                            'host': request.form['host'],
-                            'mac': request.form['mac'],
-                            'frequency': float(request.form['frequency'])
-                        }
-                        break
-                    elif data_type == 'location':
-                        entry['settings'] = {
-                            'timezone': request.form['timezone'],
-                            'lat': float(request.form['lat']),
-                            'long': float(request.form['long'])
-                        }
-                        break
-            
-            with open(self.data_file, 'w') as f:
-                json.dump(data, f, indent=4)
-
-            if data_type == 'device' and self.update_device_cb is not None:
-                self.device = self.update_device_cb()
+            def update(data):
+                # Replace the existing data entry
+                for i, entry in enumerate(data):
+                    if entry.get('type') == data_type:
+                        if data_type == 'command' and data_name == entry['name']:
+                            data[i] = dict(entry, data=request.form['data'])
+                            break
+                        elif data_type == 'device':
+                            # Devices are matched by name, unnamed ones by MAC address,
+                            # the first one if neither is given
+                            if data_name and entry.get('name') != data_name:
+                                continue
+                            if not data_name and original_mac and entry['settings'].get('mac') != original_mac:
+                                continue
+                            data[i] = dict(entry, settings={
+                                'devtype': request.form['devtype'],
+                                'host': request.form['host'],
+                                'mac': request.form['mac'],
+                                'frequency': float(request.form['frequency'])
+                            })
+                            break
+                        elif data_type == 'location':
+                            data[i] = dict(entry, settings={
+                                'timezone': request.form['timezone'],
+                                'lat': float(request.form['lat']),
+                                'long': float(request.form['long'])
+                            })
+                            break
+
+            self.change_data(update)
                 
             # Check if this is an AJAX request
             if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -232,33 +398,36 @@ class web:
     def add_data(self):
         data_name = request.form['name']
         data_value = request.form['data']
+        device_name = request.form.get('device') or None
         
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-        
-        # Add new data entry
-        data.append({
+        # Add new data entry, replacing a command with the same name
+        entry = {
             'type': 'command',
             'name': data_name,
             'data': data_value
-        })
-        
-        with open(self.data_file, 'w') as f:
-            json.dump(data, f, indent=4)
+        }
+        if device_name:
+            entry['device'] = device_name
+
+        def add(data):
+            data[:] = [itm for itm in data if itm.get('type') != 'command' or itm['name'] != data_name]
+            data.append(entry)
+
+        self.change_data(add)
     
         return redirect(url_for('settings'))
 
     def remove_data(self):
         data_name = request.form['name']
+        # Devices and scenes can have the name of a command
+        data_type = request.form.get('type', 'command')
         
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-        
+        def remove(data):
+            data[:] = [entry for entry in data
+                       if entry.get('type') != data_type or entry.get('name') != data_name]
+
         # Remove data entry
-        data[:] = [entry for entry in data if entry.get('name') != data_name]
-        
-        with open(self.data_file, 'w') as f:
-            json.dump(data, f, indent=4)
+        self.change_data(remove)
     
         return redirect(url_for('settings'))
 
@@ -267,43 +436,60 @@ class web:
         if not name:
             return jsonify({"success": False, "message": "Command name is required"})
 
-        if self.device is None:
+        # Learn on the requested device, or on the device of the command being updated
+        device_name = request.form.get('device') or self.commands.device(name)
+        device = self.devices.get(device_name)
+        if device is None:
             return jsonify({"success": False, "message": "Device not initialized"})
 
         # Get frequency from device settings
-        with open(self.data_file, 'r') as f:
-            data = json.load(f)
-            frequency = next((item['settings']['frequency'] for item in data if item['type'] == "device"), None)
+        frequency = device.settings.get('frequency')
 
         if not frequency:
             return jsonify({"success": False, "message": "Device frequency not found"})
 
-        try:
-            print(f"Learning RF command '{name}' at {frequency}Hz...", flush=True)
-            self.device.find_rf_packet(frequency)
-            time.sleep(5)  # Wait for signal
-            data = self.device.check_data()
-            
-            if data is None:
-                return jsonify({"success": False, "message": "No RF signal received"})
-
-            # Convert data to hex string
-            hex_data = ''.join(format(x, '02x') for x in data)
-
-            # Add new command to data.json
-            with open(self.data_file, 'r') as f:
-                json_data = json.load(f)
-
-            json_data.append({
-                "name": name,
-                "type": "command",
-                "data": hex_data
-            })
-
-            with open(self.data_file, 'w') as f:
-                json.dump(json_data, f, indent=4)
-
-            return jsonify({"success": True, "message": f"Command '{name}' learned successfully"})
+        # The device does not send while learning, the timeout is bounded
+        timeout = min(max(request.form.get('timeout', type=int) or LEARN_TIMEOUT, 1), LEARN_TIMEOUT)
+        session = self.learning.start(name, device, frequency, timeout, device_name)
+        return jsonify({"success": True, "session": session.id, "timeout": timeout,
+                        "message": session.message})
+
+    def learn_status(self, session_id):
+        session = self.learning.get(session_id)
+        if session is None:
+            return jsonify({"success": False, "state": "unknown", "message": "Unknown learning session"}), 404
+        return jsonify(session.status())
+
+    def learn_cancel(self, session_id):
+        session = self.learning.cancel(session_id)
+        if session is None:
+            return jsonify({"success": False, "message": "Unknown learning session"}), 404
+        return jsonify(session.status())
+
+    def save_learned(self, session):
+        # Called by the learning session when a code is received
+        name = session.name
+        device_name = session.device_name
+        hex_data = session.data.hex()
+
+        def add(json_data):
+            # Replace the command if it is learned again, otherwise add it
+            for i, entry in enumerate(json_data):
+                if entry.get('type') == 'command' and entry['name'] == name:
+                    entry = dict(entry, data=hex_data)
+                    if device_name:
+                        entry['device'] = device_name
+                    json_data[i] = entry
+                    break
+            else:
+                entry = {
+                    "name": name,
+                    "type": "command",
+                    "data": hex_data
+                }
+                if device_name:
+                    entry['device'] = device_name
+                json_data.append(entry)
 
-        except Exception as e:
-            return jsonify({"success": False, "message": f"Error learning command: {str(e)}"})
+        # Add new command to data.json
+        self.change_data(add)